@@ -5,16 +5,75 @@ Main agent implementation using OpenAI with MCP server tools.
 Includes answer evaluation, regeneration, clarification, and personalization.
 """
 
-import json
+import functools
+import queue
 import re
-from typing import List, Dict, Any, Optional, Tuple
+import threading
+import time
+from collections import deque
+from itertools import islice, takewhile
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Deque, Iterator, List, Dict, Any, Optional, Set, Tuple
 from dataclasses import dataclass, field
-from datetime import datetime
 
-from openai import OpenAI
-
-from app.config import OPENAI_API_KEY, OPENAI_MODEL, SYSTEM_PROMPT, COMPANY_NAME
+import httpx
+import orjson
+from cachetools import TTLCache
+from openai import OpenAI, OpenAIError
+
+from app.config import (
+    OPENAI_API_KEY,
+    OPENAI_MODEL,
+    OPENAI_CLASSIFIER_MODEL,
+    EMBEDDING_MODEL,
+    RESPONSE_CACHE_THRESHOLD,
+    RESPONSE_CACHE_TTL,
+    REDIS_URL,
+    SYSTEM_PROMPT,
+    COMPANY_NAME,
+)
 from app.mcp_client import get_mcp_client
+from app.semantic_cache import RedisSemanticCache, SemanticCache
+
+# Answers are shared across sessions, so only turns that used nothing but
+# these public catalog tools may be cached; order and customer tools return
+# (or change) one customer's data
+CACHEABLE_TOOLS = {"list_products", "get_product", "search_products"}
+
+# Tool results that report a failure (from _execute_tool or the MCP client)
+# rather than data; answers built on them are never cached
+_TOOL_ERROR_PREFIXES = ("Error executing ", "Error calling ")
+
+# Data source reported for each MCP tool
+_TOOL_SOURCE_MAP = {
+    "list_products": "Product Catalog",
+    "get_product": "Product Catalog",
+    "search_products": "Product Catalog",
+    "list_orders": "Order System",
+    "get_order": "Order System",
+    "create_order": "Order System",
+    "get_customer": "Customer Database",
+    "verify_customer_pin": "Customer Database",
+}
+
+# Greeting/introduction detection, compiled once at import
+_GREETING_RE = re.compile(r"\b(?:hi|hello|hey|greetings|good (?:morning|afternoon|evening))(?: there)?\b", re.I)
+# Names are any letters (e.g. "José"); _extract_name keeps only capitalized words
+_NAME_RE = re.compile(r"\b(?i:i['’ ]?m|i am|my name is|this is|call me)\s+([^\W\d_]+(?:\s+[^\W\d_]+)?)")
+_QUESTION_RE = re.compile(r"[?]|\b(?:what|which|how|can you|need|want|looking for|recommend)\b", re.I)
+_WORD_RE = re.compile(r"\w")
+_WHITESPACE_RE = re.compile(r"\s+")
+
+# Messages up to this length (normalized) share memoized classifications
+_CLASSIFY_CACHE_MAX_CHARS = 120
+
+# Longer messages are rejected before any LLM call
+MAX_MESSAGE_CHARS = 4000
+MAX_MESSAGE_WORDS = 800
+
+# Answers that ask the customer something back, or that state checkable facts
+_CLARIFYING_RE = re.compile(r"^\s*(?:could you|can you|would you|do you|what|which|how)\b[^.!]*\?", re.I)
+_FACTUAL_CLAIM_RE = re.compile(r"[\d$%]")
 
 
 @dataclass
@@ -27,151 +86,361 @@ class AgentResponse:
     regenerations: int = 0
 
 
+# Answers to first questions, keyed on the question's embedding; shared by all
+# workers through Redis when REDIS_URL is set. Payloads are plain dicts
+# ({"message", "sources_used"}) so either backend can store them
+if REDIS_URL:
+    _response_cache = RedisSemanticCache(REDIS_URL, threshold=RESPONSE_CACHE_THRESHOLD, ttl=RESPONSE_CACHE_TTL)
+else:
+    _response_cache = SemanticCache(threshold=RESPONSE_CACHE_THRESHOLD, ttl=RESPONSE_CACHE_TTL)
+
+# MCP tool definitions in OpenAI format, shared by all sessions
+_tool_definitions_cache: Optional[List[Dict[str, Any]]] = None
+_tool_definitions_lock = threading.Lock()
+
+# Shared pool for the independent, I/O-bound calls made before generation
+_preflight_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="agent-preflight")
+
+# Shared pool for running several MCP tool calls from one assistant turn at once
+_tool_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="agent-tools")
+
+
+def _request_classification(client: OpenAI, model: str, text: str, tool_names: Tuple[str, ...]) -> Dict[str, Any]:
+    """Ask the model for the name, greeting-only, coherence and scope fields of a message."""
+    response = client.chat.completions.create(
+        model=model,
+        messages=[
+            {"role": "system", "content": f"""Classify the customer support message. name: the name the customer gives for themselves, else null.
+is_intro_only: true only for a bare greeting/introduction with no question or request. coherent: false only for gibberish or a completely unclear message.
+clarification: what to ask the customer if not coherent, else null. in_scope: false only if none of these tools could help answer it: {", ".join(tool_names)}. Conversational messages (thanks, acknowledgements) and follow-ups about an earlier answer are in scope."""},
+            {"role": "user", "content": text}
+        ],
+        temperature=0.3,
+        max_tokens=60,
+        response_format={
+            "type": "json_schema",
+            "json_schema": {
+                "name": "input_classification",
+                "strict": True,
+                "schema": {
+                    "type": "object",
+                    "properties": {
+                        "name": {"type": ["string", "null"]},
+                        "is_intro_only": {"type": "boolean"},
+                        "coherent": {"type": "boolean"},
+                        "clarification": {"type": ["string", "null"]},
+                        "in_scope": {"type": "boolean"},
+                    },
+                    "required": ["name", "is_intro_only", "coherent", "clarification", "in_scope"],
+                    "additionalProperties": False,
+                },
+            },
+        },
+    )
+
+    result = orjson.loads(response.choices[0].message.content)
+    name = (result.get("name") or "").strip()
+    if name.lower() == "none" or len(name) < 2 or len(name) >= 50:
+        name = None
+    else:
+        # Capitalize first letter of each word
+        name = " ".join(word.capitalize() for word in name.split())
+
+    return {
+        "name": name,
+        "is_intro_only": bool(result.get("is_intro_only", False)),
+        "coherent": bool(result.get("coherent", True)),
+        "clarification": result.get("clarification"),
+        # Without a tool list there is nothing to judge scope against
+        "in_scope": bool(result.get("in_scope", True)) or not tool_names,
+    }
+
+
+@functools.lru_cache(maxsize=1)
+def _get_openai_client() -> OpenAI:
+    """Get the OpenAI client shared by all agent sessions."""
+    return OpenAI(
+        api_key=OPENAI_API_KEY,
+        http_client=httpx.Client(
+            limits=httpx.Limits(max_connections=200, max_keepalive_connections=100),
+            timeout=30.0,
+        ),
+    )
+
+
+@functools.lru_cache(maxsize=4096)
+def _classify_normalized(normalized: str, model: str, tool_names: Tuple[str, ...]) -> Dict[str, Any]:
+    """Classify a normalized message, memoized across sessions (e.g. for "hi")."""
+    return _request_classification(_get_openai_client(), model, normalized, tool_names)
+
+
+class EmbeddingBatcher:
+    """Coalesces embedding requests from concurrent turns into shared API calls."""
+
+    def __init__(self, max_batch: int = 32, max_wait: float = 0.005):
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._queue: "queue.Queue[Tuple[str, Future]]" = queue.Queue()
+        # Batches are sent from a separate pool so the collector keeps gathering
+        # the next batch while one is in flight
+        self._senders = ThreadPoolExecutor(max_workers=4, thread_name_prefix="agent-embed")
+        self._collector: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def embed(self, text: str) -> Optional[List[float]]:
+        """Embed one text, waiting up to max_wait for other requests to batch with."""
+        if self._collector is None:
+            with self._lock:
+                if self._collector is None:
+                    self._collector = threading.Thread(target=self._collect, name="agent-embed-batcher", daemon=True)
+                    self._collector.start()
+        future: Future = Future()
+        self._queue.put((text, future))
+        return future.result()
+
+    def _collect(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._senders.submit(self._send, batch)
+
+    @staticmethod
+    def _send(batch: List[Tuple[str, Future]]) -> None:
+        # Identical texts in a batch share one input
+        texts = list(dict.fromkeys(text for text, _ in batch))
+        try:
+            embeddings = dict(zip(texts, embed_messages(texts)))
+        except Exception:
+            embeddings = {}
+        for text, future in batch:
+            # Never leave a caller waiting; a missing embedding is a cache miss
+            future.set_result(embeddings.get(text))
+
+
+_embedding_batcher = EmbeddingBatcher()
+
+
 class CustomerSupportAgent:
     """Agentic customer support assistant using MCP server tools."""
 
     def __init__(self):
-        self.client = OpenAI(api_key=OPENAI_API_KEY)
+        self.client = _get_openai_client()
         self.model = OPENAI_MODEL
-        self.conversation_history: List[Dict[str, Any]] = []
+        self.classifier_model = OPENAI_CLASSIFIER_MODEL
+        self.conversation_history: Deque[Dict[str, Any]] = deque(maxlen=40)
         self.system_prompt = SYSTEM_PROMPT
         self.mcp_client = get_mcp_client()
-        self._tool_definitions = None
         self.customer_name: Optional[str] = None
         self.max_regenerations = 3
+        # Older turns are folded into a running summary once the history grows
+        # past max_history_messages, keeping only the most recent ones verbatim
+        self.conversation_summary: Optional[str] = None
+        self.max_history_messages = 12
+        self.recent_history_messages = 6
+        # Cached answers are only reused while the session has no prior answer
+        # a follow-up question could refer to
+        self._has_answered = False
+        # Held by callers for a whole turn when chat() may run on several threads
+        self.lock = threading.Lock()
     
     def _get_tool_definitions(self) -> List[Dict[str, Any]]:
         """Get tool definitions from MCP server and convert to OpenAI format."""
-        if self._tool_definitions is not None:
-            return self._tool_definitions
-        
-        mcp_tools = self.mcp_client.list_tools()
-        openai_tools = []
+        global _tool_definitions_cache
+        if _tool_definitions_cache is not None:
+            return _tool_definitions_cache
         
-        for tool in mcp_tools:
-            # Convert MCP tool to OpenAI function format
-            openai_tool = {
-                "type": "function",
-                "function": {
-                    "name": tool["name"],
-                    "description": tool.get("description", f"Call {tool['name']} tool"),
-                    "parameters": tool.get("inputSchema", {
-                        "type": "object",
-                        "properties": {},
-                        "required": []
-                    })
+        with _tool_definitions_lock:
+            if _tool_definitions_cache is not None:
+                return _tool_definitions_cache
+            
+            mcp_tools = self.mcp_client.list_tools()
+            openai_tools = []
+            
+            for tool in mcp_tools:
+                # Convert MCP tool to OpenAI function format
+                openai_tool = {
+                    "type": "function",
+                    "function": {
+                        "name": tool["name"],
+                        "description": tool.get("description", f"Call {tool['name']} tool"),
+                        "parameters": tool.get("inputSchema", {
+                            "type": "object",
+                            "properties": {},
+                            "required": []
+                        })
+                    }
                 }
-            }
-            openai_tools.append(openai_tool)
-        
-        self._tool_definitions = openai_tools
-        return openai_tools
+                openai_tools.append(openai_tool)
+            
+            # Don't cache an empty list from an unreachable server
+            if openai_tools:
+                _tool_definitions_cache = openai_tools
+            return openai_tools
     
     def _extract_name(self, text: str) -> Optional[str]:
-        """Extract a name from user input using LLM."""
-        try:
-            response = self.client.chat.completions.create(
-                model=self.model,
-                messages=[
-                    {"role": "system", "content": "Extract the person's name from the text. Return only the name, or 'none' if no name is found."},
-                    {"role": "user", "content": text}
-                ],
-                temperature=0.3,
-                max_tokens=20
-            )
-            name = response.choices[0].message.content.strip().lower()
-            if name and name != "none" and len(name) > 1 and len(name) < 50:
-                # Capitalize first letter of each word
-                return " ".join(word.capitalize() for word in name.split())
-            return None
-        except:
+        """Extract a self-introduced name (e.g. "I'm John") from user input."""
+        match = _NAME_RE.search(text)
+        if not match:
             return None
+        words = list(takewhile(lambda word: word[0].isupper(), match.group(1).split()))
+        return " ".join(words) or None
     
-    def _check_question_coherence(self, question: str) -> Tuple[bool, Optional[str]]:
-        """Check if question is coherent and can be understood."""
+    def _classify_input(self, user_message: str, tool_names: Tuple[str, ...] = ()) -> Dict[str, Any]:
+        """Classify user input (name, greeting, coherence, scope) in a single LLM call."""
+        normalized = _WHITESPACE_RE.sub(" ", user_message.strip().lower())
         try:
-            
-            response = self.client.chat.completions.create(
-                model=self.model,
-                messages=[
-                    {"role": "system", "content": """You are evaluating if a customer question is coherent and understandable.
-
-A question is INCOHERENT if:
-- It's just random characters or gibberish (e.g., "asdfghjkl")
-- It makes no grammatical sense
-- It's completely unclear what the customer is asking
-
-A question is COHERENT if:
-- It's a real question, even if vague
-- It asks for product recommendations, information, or help
-- It's understandable, even if you need to ask follow-up questions
-
-Return JSON: {"coherent": true/false, "clarification": "what to ask if incoherent"}
-Only mark as incoherent if it's truly gibberish or completely unclear."""},
-                    {"role": "user", "content": question}
-                ],
-                temperature=0.3,
-                response_format={"type": "json_object"}
-            )
-            
-            result = json.loads(response.choices[0].message.content)
-            coherent = result.get("coherent", True)
-            clarification = result.get("clarification")
-            
-            if not coherent:
-                return False, clarification or "Could you please rephrase your question? I want to make sure I understand what you're looking for."
-            return True, None
-        except Exception as e:
-            # If evaluation fails, assume coherent and proceed
-            return True, None
+            # Short messages repeat often across sessions; long ones are classified as-is
+            if len(normalized) <= _CLASSIFY_CACHE_MAX_CHARS:
+                return dict(_classify_normalized(normalized, self.classifier_model, tool_names))
+            return _request_classification(self.client, self.classifier_model, user_message, tool_names)
+        except Exception:
+            # If classification fails, fall back to heuristics and assume coherent
+            return {
+                "name": None,
+                "is_intro_only": self._is_introduction_or_greeting(user_message),
+                "coherent": True,
+                "clarification": None,
+                "in_scope": True,
+            }
     
     def _evaluate_answer(self, answer: str, question: str, tools_used: List[str]) -> Tuple[bool, Optional[str]]:
         """Evaluate if the answer is satisfactory."""
         try:
-            # Skip evaluation for greeting responses (they're handled separately)
-            if self._is_introduction_or_greeting(question):
-                return True, None
-            
             response = self.client.chat.completions.create(
-                model=self.model,
+                model=self.classifier_model,
                 messages=[
-                    {"role": "system", "content": """Evaluate if the answer is satisfactory. Check:
-1. Does it directly address the question?
-2. Is it helpful and informative?
-3. Is it polite and professional?
-4. Does it avoid making up information?
-
-IMPORTANT: If the question was just a greeting/introduction, the answer should be a warm welcome - that's satisfactory.
-
-Return JSON: {"satisfactory": true/false, "reason": "why not satisfactory if false"}
-If satisfactory=false, provide a brief reason."""},
+                    {"role": "system", "content": """Judge whether the support answer directly, helpfully and politely addresses the question without making up information.
+If not satisfactory, give a brief reason; otherwise reason is null."""},
                     {"role": "user", "content": f"Question: {question}\n\nAnswer: {answer}\n\nTools used: {', '.join(tools_used) if tools_used else 'none'}"}
                 ],
                 temperature=0.3,
-                response_format={"type": "json_object"}
+                max_tokens=60,
+                response_format={
+                    "type": "json_schema",
+                    "json_schema": {
+                        "name": "answer_evaluation",
+                        "strict": True,
+                        "schema": {
+                            "type": "object",
+                            "properties": {
+                                "satisfactory": {"type": "boolean"},
+                                "reason": {"type": ["string", "null"]},
+                            },
+                            "required": ["satisfactory", "reason"],
+                            "additionalProperties": False,
+                        },
+                    },
+                },
             )
             
-            result = json.loads(response.choices[0].message.content)
+            result = orjson.loads(response.choices[0].message.content)
             satisfactory = result.get("satisfactory", True)
             reason = result.get("reason")
             
             return satisfactory, reason
-        except Exception as e:
+        except Exception:
             # If evaluation fails, assume satisfactory
             return True, None
     
+    def _needs_evaluation(self, answer: str, tools_used: List[str]) -> bool:
+        """Check if an answer is worth a judge call, skipping short factless replies."""
+        if _CLARIFYING_RE.match(answer):
+            return False
+        if not tools_used and len(answer) < 200 and not _FACTUAL_CLAIM_RE.search(answer):
+            return False
+        return True
+    
+    def _embed(self, text: str) -> Optional[List[float]]:
+        """Embed text for semantic cache lookups, batched with concurrent turns."""
+        return _embedding_batcher.embed(text)
+    
+    def _preflight(self, user_message: str, query_embedding: Optional[List[float]] = None) -> Tuple[Dict[str, Any], List[Dict[str, Any]], Optional[List[float]]]:
+        """Run tool discovery and input classification while the cache embedding is computed."""
+        pending_embedding = None
+        if self._has_answered:
+            # Only first questions are answered from the cache
+            query_embedding = None
+        elif query_embedding is None:
+            pending_embedding = _preflight_executor.submit(self._embed, user_message)
+        
+        # The classifier judges scope against the tool list, which is cached per process
+        tool_definitions = self._get_tool_definitions()
+        tool_names = tuple(tool["function"]["name"] for tool in tool_definitions)
+        classification = self._classify_input(user_message, tool_names)
+        
+        return (
+            classification,
+            tool_definitions,
+            pending_embedding.result() if pending_embedding else query_embedding,
+        )
+    
     def _build_messages(self, user_message: str) -> List[Dict[str, Any]]:
         """Build the messages array for the API call."""
-        # Enhance system prompt with customer name if available
-        system_prompt = self.system_prompt
+        # Keep the static system prompt first and byte-identical across calls so
+        # OpenAI prompt caching can reuse the prefix; per-session details follow it
+        messages = [{"role": "system", "content": self.system_prompt}]
         if self.customer_name:
-            system_prompt += f"\n\nIMPORTANT: The customer's name is {self.customer_name}. Use their name naturally in your responses to personalize the conversation."
-        
-        messages = [{"role": "system", "content": system_prompt}]
+            messages.append({"role": "system", "content": f"Customer name: {self.customer_name}. Use their name naturally in your responses to personalize the conversation."})
+        if self.conversation_summary:
+            messages.append({"role": "system", "content": f"Summary of the earlier conversation: {self.conversation_summary}"})
         messages.extend(self.conversation_history)
         messages.append({"role": "user", "content": user_message})
         return messages
     
+    def _summarize_older(self, messages: List[Dict[str, Any]]) -> Optional[str]:
+        """Fold older conversation turns into the running conversation summary."""
+        transcript = "\n".join(f"{m['role']}: {m['content']}" for m in messages)
+        if self.conversation_summary:
+            transcript = f"Earlier summary: {self.conversation_summary}\n\n{transcript}"
+        
+        try:
+            response = self.client.chat.completions.create(
+                model=self.classifier_model,
+                messages=[
+                    {"role": "system", "content": "Summarize this customer support conversation in a few sentences. Keep the customer's needs, products and order numbers discussed, and any decisions made."},
+                    {"role": "user", "content": transcript}
+                ],
+                temperature=0.3,
+                max_tokens=200
+            )
+            return response.choices[0].message.content.strip() or None
+        except Exception:
+            return None
+    
+    def _is_cacheable(self, tool_definitions: List[Dict[str, Any]], tools_called: List[str], tool_errors: List[str]) -> bool:
+        """Check whether this turn's answer is safe to serve to other sessions."""
+        # Answers generated with the customer's name in context mention it, and
+        # answers written without working tools (MCP down or a call failing)
+        # would keep serving the outage after it's over
+        return (
+            not self.customer_name
+            and bool(tool_definitions)
+            and not tool_errors
+            and CACHEABLE_TOOLS.issuperset(tools_called)
+        )
+    
+    def _record_turn(self, user_message: str, assistant_message: str):
+        """Append a turn to the history, summarizing older turns when it grows too long."""
+        self.conversation_history.append({"role": "user", "content": user_message})
+        self.conversation_history.append({"role": "assistant", "content": assistant_message})
+        
+        if len(self.conversation_history) > self.max_history_messages:
+            older_count = len(self.conversation_history) - self.recent_history_messages
+            summary = self._summarize_older(list(islice(self.conversation_history, older_count)))
+            # If summarization fails, keep the full history until the next attempt
+            if summary:
+                self.conversation_summary = summary
+                for _ in range(older_count):
+                    self.conversation_history.popleft()
+    
     def _execute_tool(self, tool_name: str, tool_args: Dict[str, Any]) -> str:
         """Execute a tool via MCP server."""
         try:
@@ -180,72 +449,136 @@ If satisfactory=false, provide a brief reason."""},
         except Exception as e:
             return f"Error executing {tool_name}: {str(e)}"
     
-    def _generate_response(self, messages: List[Dict[str, Any]], tool_definitions: List[Dict[str, Any]]) -> Tuple[str, List[str], List[str], Any]:
+    def _run_tool_calls(self, messages: List[Dict[str, Any]], content: Optional[str], tool_calls: List[Dict[str, Any]], tools_called: List[str], sources_used: Set[str], tool_errors: List[str]):
+        """Execute the tool calls requested by the assistant and append their results to messages.
+
+        Tools whose call failed are also appended to tool_errors.
+        """
+        messages.append({
+            "role": "assistant",
+            "content": content,
+            "tool_calls": tool_calls,
+        })
+
+        parsed_calls = []
+        for tool_call in tool_calls:
+            try:
+                tool_args = orjson.loads(tool_call["function"]["arguments"])
+            except orjson.JSONDecodeError:
+                tool_args = {}
+            parsed_calls.append((tool_call["function"]["name"], tool_args))
+
+        # MCP calls are network-bound, so run them concurrently; map() keeps their order
+        if len(parsed_calls) > 1:
+            tool_results = list(_tool_executor.map(lambda call: self._execute_tool(*call), parsed_calls))
+        else:
+            tool_results = [self._execute_tool(*call) for call in parsed_calls]
+
+        for tool_call, (tool_name, _), tool_result in zip(tool_calls, parsed_calls, tool_results):
+            tools_called.append(tool_name)
+            if tool_result.startswith(_TOOL_ERROR_PREFIXES):
+                tool_errors.append(tool_name)
+
+            # Track sources based on tool type
+            source = _TOOL_SOURCE_MAP.get(tool_name)
+            if source:
+                sources_used.add(source)
+
+            messages.append({
+                "role": "tool",
+                "tool_call_id": tool_call["id"],
+                "content": tool_result,
+            })
+    
+    def _completion_options(self, tool_definitions: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """Build the completion options shared by every call in a tool loop."""
+        # The API rejects an empty tools list, e.g. when the MCP server is unreachable
+        if not tool_definitions:
+            return {"model": self.model}
+        return {"model": self.model, "tools": tool_definitions, "tool_choice": "auto"}
+    
+    def _generate_response(self, messages: List[Dict[str, Any]], tool_definitions: List[Dict[str, Any]]) -> Tuple[str, List[str], Set[str], List[str], Any]:
         """Generate a response using the LLM."""
         tools_called = []
-        sources_used = []
+        sources_used = set()
+        tool_errors = []
+        completion_options = self._completion_options(tool_definitions)
         
-        response = self.client.chat.completions.create(
-            model=self.model,
-            messages=messages,
-            tools=tool_definitions,
-            tool_choice="auto",
-        )
+        response = self.client.chat.completions.create(messages=messages, **completion_options)
 
         assistant_message = response.choices[0].message
 
         while assistant_message.tool_calls:
-            messages.append({
-                "role": "assistant",
-                "content": assistant_message.content,
-                "tool_calls": [
-                    {
-                        "id": tc.id,
-                        "type": "function",
-                        "function": {
-                            "name": tc.function.name,
-                            "arguments": tc.function.arguments
-                        }
+            tool_calls = [
+                {
+                    "id": tc.id,
+                    "type": "function",
+                    "function": {
+                        "name": tc.function.name,
+                        "arguments": tc.function.arguments
                     }
-                    for tc in assistant_message.tool_calls
-                ]
-            })
-
-            for tool_call in assistant_message.tool_calls:
-                tool_name = tool_call.function.name
-                try:
-                    tool_args = json.loads(tool_call.function.arguments)
-                except json.JSONDecodeError:
-                    tool_args = {}
-
-                tools_called.append(tool_name)
-                tool_result = self._execute_tool(tool_name, tool_args)
-
-                # Track sources based on tool type
-                if tool_name in ["list_products", "get_product", "search_products"]:
-                    sources_used.append("Product Catalog")
-                elif tool_name in ["list_orders", "get_order", "create_order"]:
-                    sources_used.append("Order System")
-                elif tool_name in ["get_customer", "verify_customer_pin"]:
-                    sources_used.append("Customer Database")
-
-                messages.append({
-                    "role": "tool",
-                    "tool_call_id": tool_call.id,
-                    "content": tool_result,
-                })
+                }
+                for tc in assistant_message.tool_calls
+            ]
+            self._run_tool_calls(messages, assistant_message.content, tool_calls, tools_called, sources_used, tool_errors)
 
-            response = self.client.chat.completions.create(
-                model=self.model,
-                messages=messages,
-                tools=tool_definitions,
-                tool_choice="auto",
-            )
+            response = self.client.chat.completions.create(messages=messages, **completion_options)
             assistant_message = response.choices[0].message
 
         final_response = assistant_message.content or "I apologize, but I couldn't generate a response."
         
-        return final_response, tools_called, sources_used, response
+        return final_response, tools_called, sources_used, tool_errors, response
+    
+    def _stream_response(self, messages: List[Dict[str, Any]], tool_definitions: List[Dict[str, Any]], tools_called: List[str], sources_used: Set[str], tool_errors: List[str], token_usage: Dict[str, int]) -> Iterator[str]:
+        """Generate a response using the LLM, yielding text deltas as they arrive.
+
+        Tool calls are accumulated from the stream and executed between completions;
+        tools_called, sources_used, tool_errors and token_usage are filled in as a side effect.
+        """
+        completion_options = self._completion_options(tool_definitions)
+        while True:
+            stream = self.client.chat.completions.create(
+                messages=messages,
+                stream=True,
+                stream_options={"include_usage": True},
+                **completion_options,
+            )
+
+            content_parts = []
+            tool_calls: Dict[int, Dict[str, Any]] = {}
+            for chunk in stream:
+                if chunk.usage:
+                    token_usage.update({
+                        "prompt_tokens": chunk.usage.prompt_tokens,
+                        "completion_tokens": chunk.usage.completion_tokens,
+                        "total_tokens": chunk.usage.total_tokens,
+                    })
+                if not chunk.choices:
+                    continue
+                
+                delta = chunk.choices[0].delta
+                if delta.content:
+                    content_parts.append(delta.content)
+                    yield delta.content
+                # Tool calls arrive in fragments keyed by index
+                for tc in delta.tool_calls or []:
+                    call = tool_calls.setdefault(tc.index, {
+                        "id": None,
+                        "type": "function",
+                        "function": {"name": "", "arguments": ""},
+                    })
+                    if tc.id:
+                        call["id"] = tc.id
+                    if tc.function and tc.function.name:
+                        call["function"]["name"] += tc.function.name
+                    if tc.function and tc.function.arguments:
+                        call["function"]["arguments"] += tc.function.arguments
+
+            if not tool_calls:
+                return
+            
+            ordered_calls = [tool_calls[index] for index in sorted(tool_calls)]
+            self._run_tool_calls(messages, "".join(content_parts) or None, ordered_calls, tools_called, sources_used, tool_errors)
     
     def _handle_unanswerable_question(self, question: str) -> str:
         """Generate a polite response for questions that can't be answered with available tools."""
@@ -261,49 +594,61 @@ For other questions or complex issues, please contact our support team at suppor
     
     def _is_introduction_or_greeting(self, message: str) -> bool:
         """Check if message is just an introduction or greeting without a question."""
-        try:
-            response = self.client.chat.completions.create(
-                model=self.model,
-                messages=[
-                    {"role": "system", "content": """Determine if this message is:
-1. Just a greeting or introduction (e.g., "Hi", "Hello", "I'm John", "Hi there, I am Joshua")
-2. A greeting/introduction WITH a question or request (e.g., "Hi, I need a printer")
-
-Return JSON: {"is_intro_only": true/false}
-Only return true if it's ONLY a greeting/introduction with no question or request."""},
-                    {"role": "user", "content": message}
-                ],
-                temperature=0.3,
-                response_format={"type": "json_object"}
-            )
-            result = json.loads(response.choices[0].message.content)
-            return result.get("is_intro_only", False)
-        except:
-            # If check fails, use simple heuristics
-            message_lower = message.lower().strip()
-            # Check if it's just a greeting pattern
-            greeting_patterns = ["hi there", "hello", "hey", "hi, i am", "i am", "i'm", "my name is"]
-            has_greeting = any(pattern in message_lower for pattern in greeting_patterns)
-            has_question_words = any(word in message_lower for word in ["?", "what", "which", "how", "can you", "need", "want", "looking for"])
-            return has_greeting and not has_question_words and len(message.split()) < 15
+        if _QUESTION_RE.search(message) or len(message.split()) >= 15:
+            return False
+        name = self._extract_name(message)
+        if not (_GREETING_RE.search(message) or name):
+            return False
+        # Only a greeting/introduction if nothing but punctuation is left
+        remainder = _GREETING_RE.sub(" ", message)
+        if name:
+            remainder = _NAME_RE.sub(" ", remainder)
+        return not _WORD_RE.search(remainder)
     
-    def chat(self, user_message: str) -> AgentResponse:
-        """Process a user message and generate a response."""
-        # Extract and store customer name
-        extracted_name = self._extract_name(user_message)
-        is_first_interaction = not self.customer_name and extracted_name
+    def _handle_preflight(self, user_message: str, precomputed_embedding: Optional[List[float]] = None) -> Tuple[Optional[AgentResponse], List[Dict[str, Any]], Optional[List[float]], bool]:
+        """Classify the message and answer greetings or incoherent input directly.
+
+        Returns (immediate response or None, tool definitions, cache embedding,
+        whether this message introduced the customer's name).
+        """
+        tool_definitions: List[Dict[str, Any]] = []
+        query_embedding = None
+        
+        # Reject oversized input up front; it isn't added to the history
+        if len(user_message) > MAX_MESSAGE_CHARS or len(user_message.split()) > MAX_MESSAGE_WORDS:
+            return AgentResponse(
+                message="Your message is too long. Please shorten it and try again.",
+            ), tool_definitions, query_embedding, False
+        
+        if self._is_introduction_or_greeting(user_message):
+            # Plain greetings/introductions don't need the LLM classifier
+            classification = {
+                "name": self._extract_name(user_message),
+                "is_intro_only": True,
+                "coherent": True,
+                "clarification": None,
+                "in_scope": True,
+            }
+        else:
+            # Classify the input (name, greeting, coherence, scope) while the
+            # cache embedding is fetched in parallel
+            classification, tool_definitions, query_embedding = self._preflight(user_message, precomputed_embedding)
+
+        # Store the customer's name: the regex only decides on the greeting-only
+        # fast path, since it can't tell "I am Unable to log in" from an introduction
+        extracted_name = classification["name"]
+        is_first_interaction = bool(not self.customer_name and extracted_name)
         if extracted_name and not self.customer_name:
             self.customer_name = extracted_name
         
         # Check if this is just an introduction/greeting
-        if self._is_introduction_or_greeting(user_message):
+        if classification["is_intro_only"]:
             if self.customer_name:
                 greeting_response = f"Hello {self.customer_name}! Welcome to {COMPANY_NAME} support. I'm here to help you find the right products, check orders, and answer any questions you might have. How can I assist you today?"
             else:
                 greeting_response = f"Hello! Welcome to {COMPANY_NAME} support. I'm here to help you find the right products, check orders, and answer any questions you might have. How can I assist you today?"
             
-            self.conversation_history.append({"role": "user", "content": user_message})
-            self.conversation_history.append({"role": "assistant", "content": greeting_response})
+            self._record_turn(user_message, greeting_response)
             
             return AgentResponse(
                 message=greeting_response,
@@ -311,17 +656,16 @@ Only return true if it's ONLY a greeting/introduction with no question or reques
                 tools_called=[],
                 token_usage={},
                 regenerations=0
-            )
+            ), tool_definitions, query_embedding, is_first_interaction
         
         # Check question coherence
-        is_coherent, clarification = self._check_question_coherence(user_message)
-        if not is_coherent:
+        if not classification["coherent"]:
+            clarification = classification["clarification"]
             clarification_response = clarification or "Could you please rephrase your question? I want to make sure I understand what you're looking for."
             if self.customer_name:
                 clarification_response = f"{self.customer_name}, {clarification_response.lower()}"
             
-            self.conversation_history.append({"role": "user", "content": user_message})
-            self.conversation_history.append({"role": "assistant", "content": clarification_response})
+            self._record_turn(user_message, clarification_response)
             
             return AgentResponse(
                 message=clarification_response,
@@ -329,40 +673,82 @@ Only return true if it's ONLY a greeting/introduction with no question or reques
                 tools_called=[],
                 token_usage={},
                 regenerations=0
-            )
+            ), tool_definitions, query_embedding, is_first_interaction
         
-        # Get tool definitions for response generation
-        tool_definitions = self._get_tool_definitions()
+        # Answer questions none of the tools can help with without calling the LLM.
+        # The classifier only sees this message, so once the session has an answer
+        # a follow-up could refer to, the model judges scope with the history
+        if not classification["in_scope"] and not self._has_answered:
+            unanswerable_response = self._handle_unanswerable_question(user_message)
+            self._record_turn(user_message, unanswerable_response)
+            
+            return AgentResponse(
+                message=unanswerable_response,
+                sources_used=[],
+                tools_called=[],
+                token_usage={},
+                regenerations=0
+            ), tool_definitions, query_embedding, is_first_interaction
         
-        # Note: We removed the strict pre-check for answerability because:
-        # 1. Recommendation questions (e.g., "which printer should I get") CAN be answered
-        #    by using list_products/search_products and then making recommendations
-        # 2. The LLM with tools will naturally handle unanswerable questions
-        # 3. The evaluation step will catch truly unsatisfactory answers
+        return None, tool_definitions, query_embedding, is_first_interaction
+    
+    def chat(self, user_message: str, query_embedding: Optional[List[float]] = None) -> AgentResponse:
+        """Process a user message and generate a response.
+
+        query_embedding may carry the message's embedding when the caller has
+        already computed it (e.g. once for duplicate messages in a batch).
+        """
+        early_response, tool_definitions, query_embedding, is_first_interaction = self._handle_preflight(user_message, query_embedding)
+        if early_response:
+            return early_response
         
-        # Generate initial response
-        messages = self._build_messages(user_message)
-        final_response, tools_called, sources_used, response = self._generate_response(messages, tool_definitions)
+        # Note: The preflight only rejects questions none of the tools could help with.
+        # Recommendation questions (e.g., "which printer should I get") CAN be answered
+        # by using list_products/search_products and then making recommendations, and
+        # the evaluation step will catch truly unsatisfactory answers
         
-        # Evaluate and regenerate if needed
+        # Reuse the answer to a semantically equivalent question if one is cached
+        hits = _response_cache.query(query_embedding) if query_embedding is not None else []
+        cached = hits[0][1] if hits else None
+
         regenerations = 0
-        for attempt in range(self.max_regenerations):
-            satisfactory, reason = self._evaluate_answer(final_response, user_message, tools_called)
-            if satisfactory:
-                break
+        if cached:
+            final_response = cached["message"]
+            tools_called = []
+            sources_used = set(cached["sources_used"])
+            response = None
+        else:
+            # Generate initial response
+            messages = self._build_messages(user_message)
+            final_response, tools_called, sources_used, tool_errors, response = self._generate_response(messages, tool_definitions)
             
-            regenerations += 1
-            # Regenerate with feedback
-            messages.append({
-                "role": "assistant",
-                "content": final_response
-            })
-            messages.append({
-                "role": "user",
-                "content": f"The previous answer was not satisfactory: {reason}. Please provide a better answer."
-            })
-            
-            final_response, tools_called, sources_used, response = self._generate_response(messages, tool_definitions)
+            # Evaluate and regenerate if needed
+            if self._needs_evaluation(final_response, tools_called):
+                for attempt in range(self.max_regenerations):
+                    satisfactory, reason = self._evaluate_answer(final_response, user_message, tools_called)
+                    if satisfactory:
+                        break
+                    
+                    regenerations += 1
+                    # Regenerate with feedback
+                    messages.append({
+                        "role": "assistant",
+                        "content": final_response
+                    })
+                    messages.append({
+                        "role": "user",
+                        "content": f"The previous answer was not satisfactory: {reason}. Please provide a better answer."
+                    })
+                    
+                    final_response, tools_called, sources_used, tool_errors, response = self._generate_response(messages, tool_definitions)
+
+            # Cache answers to similar questions when nothing customer-specific went into them
+            if query_embedding is not None and self._is_cacheable(tool_definitions, tools_called, tool_errors):
+                _response_cache.update(query_embedding, {
+                    "message": final_response,
+                    "sources_used": list(sources_used),
+                })
+        self._has_answered = True
         
         # Personalize response if customer name is available
         if self.customer_name:
@@ -384,45 +770,152 @@ Only return true if it's ONLY a greeting/introduction with no question or reques
                 if not final_response.startswith(self.customer_name):
                     final_response = f"{self.customer_name}, {final_response.lower()}"
         
-        self.conversation_history.append({"role": "user", "content": user_message})
-        self.conversation_history.append({"role": "assistant", "content": final_response})
-
-        if len(self.conversation_history) > 40:
-            self.conversation_history = self.conversation_history[-40:]
+        self._record_turn(user_message, final_response)
 
         return AgentResponse(
             message=final_response,
-            sources_used=list(set(sources_used)),
+            sources_used=list(sources_used),
             tools_called=tools_called,
             token_usage={
-                "prompt_tokens": response.usage.prompt_tokens if response.usage else 0,
-                "completion_tokens": response.usage.completion_tokens if response.usage else 0,
-                "total_tokens": response.usage.total_tokens if response.usage else 0,
+                "prompt_tokens": response.usage.prompt_tokens if response and response.usage else 0,
+                "completion_tokens": response.usage.completion_tokens if response and response.usage else 0,
+                "total_tokens": response.usage.total_tokens if response and response.usage else 0,
             },
             regenerations=regenerations
         )
 
+    def chat_stream(self, user_message: str) -> Iterator[AgentResponse]:
+        """Process a user message, yielding the response as it is generated.
+
+        Each partial AgentResponse carries a text delta in `message`; the last one
+        has an empty message and the sources, tools and token usage for the turn.
+        Streamed answers are not evaluated/regenerated or post-personalized, since
+        text already sent cannot be revised; the model still sees the customer's name.
+        """
+        early_response, tool_definitions, query_embedding, _ = self._handle_preflight(user_message)
+        if early_response:
+            yield early_response
+            return
+        
+        tools_called: List[str] = []
+        sources_used: Set[str] = set()
+        tool_errors: List[str] = []
+        token_usage: Dict[str, int] = {}
+        
+        hits = _response_cache.query(query_embedding) if query_embedding is not None else []
+        cached = hits[0][1] if hits else None
+        if cached:
+            final_response = cached["message"]
+            sources_used = set(cached["sources_used"])
+            yield AgentResponse(message=final_response)
+        else:
+            messages = self._build_messages(user_message)
+            parts = []
+            for delta in self._stream_response(messages, tool_definitions, tools_called, sources_used, tool_errors, token_usage):
+                parts.append(delta)
+                yield AgentResponse(message=delta)
+            
+            final_response = "".join(parts)
+            if not final_response:
+                final_response = "I apologize, but I couldn't generate a response."
+                yield AgentResponse(message=final_response)
+            
+            if query_embedding is not None and self._is_cacheable(tool_definitions, tools_called, tool_errors):
+                _response_cache.update(query_embedding, {
+                    "message": final_response,
+                    "sources_used": list(sources_used),
+                })
+        self._has_answered = True
+        
+        self._record_turn(user_message, final_response)
+        
+        yield AgentResponse(
+            message="",
+            sources_used=list(sources_used),
+            tools_called=tools_called,
+            token_usage=token_usage,
+        )
+
     def reset_conversation(self):
         """Clear conversation history."""
-        self.conversation_history = []
+        self.conversation_history.clear()
+        self.conversation_summary = None
         self.customer_name = None
+        self._has_answered = False
 
     def get_conversation_history(self) -> List[Dict[str, Any]]:
         """Get the current conversation history."""
-        return self.conversation_history.copy()
+        return list(self.conversation_history)
 
 
-_agent_sessions: Dict[str, CustomerSupportAgent] = {}
+# Sessions idle for longer than the TTL are dropped, and the oldest are
+# evicted first once maxsize is reached
+_agent_sessions: TTLCache = TTLCache(maxsize=10_000, ttl=3600)
+_agent_sessions_lock = threading.RLock()
+# get_agent lookups that found a live session vs. had to create one
+_agent_session_hits = 0
+_agent_session_misses = 0
 
 
 def get_agent(session_id: str) -> CustomerSupportAgent:
     """Get or create an agent for a session."""
-    if session_id not in _agent_sessions:
-        _agent_sessions[session_id] = CustomerSupportAgent()
-    return _agent_sessions[session_id]
+    global _agent_session_hits, _agent_session_misses
+    with _agent_sessions_lock:
+        agent = _agent_sessions.get(session_id)
+        if agent is None:
+            _agent_session_misses += 1
+            agent = CustomerSupportAgent()
+        else:
+            _agent_session_hits += 1
+        # Re-insert on every access so the TTL counts from the last use
+        _agent_sessions[session_id] = agent
+        return agent
+
+
+def session_stats() -> Dict[str, int]:
+    """Live session count and get_agent hit/miss counters since startup."""
+    with _agent_sessions_lock:
+        _agent_sessions.expire()
+        return {
+            "active": len(_agent_sessions),
+            "max_sessions": int(_agent_sessions.maxsize),
+            "hits": _agent_session_hits,
+            "misses": _agent_session_misses,
+        }
+
+
+def embed_messages(messages: List[str]) -> List[Optional[List[float]]]:
+    """Embed several messages in one request for semantic cache lookups."""
+    try:
+        response = _get_openai_client().embeddings.create(model=EMBEDDING_MODEL, input=messages)
+        return [item.embedding for item in response.data]
+    except OpenAIError:
+        return [None] * len(messages)
+
+
+def warm_up() -> None:
+    """Build the shared tool definitions and open a pooled OpenAI connection ahead of the first request."""
+    CustomerSupportAgent()._get_tool_definitions()
+    # A one-token embedding is the cheapest request that completes the TLS handshake
+    embed_messages(["warmup"])
+
+
+def invalidate_cached_responses(topic: Optional[str] = None, threshold: float = 0.8) -> int:
+    """Drop cached answers to questions close to `topic` (all of them without one); returns the count."""
+    if topic is None:
+        return _response_cache.clear()
+    response = _get_openai_client().embeddings.create(model=EMBEDDING_MODEL, input=topic)
+    return _response_cache.invalidate(response.data[0].embedding, threshold)
+
+
+def invalidate_tool_cache():
+    """Drop cached MCP tool definitions so they are re-fetched on next use."""
+    global _tool_definitions_cache
+    with _tool_definitions_lock:
+        _tool_definitions_cache = None
 
 
 def clear_session(session_id: str):
     """Clear a session's agent."""
-    if session_id in _agent_sessions:
-        del _agent_sessions[session_id]
+    with _agent_sessions_lock:
+        _agent_sessions.pop(session_id, None)
@@ -70,6 +70,49 @@ Remember: You have access to tools via the MCP server to look up product informa
 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
+# Cheaper, faster model for classification, answer evaluation and summarization
+OPENAI_CLASSIFIER_MODEL = os.getenv("OPENAI_CLASSIFIER_MODEL", "gpt-4.1-nano")
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-3-small")
+
+# Minimum cosine similarity for reusing a cached answer to a similar question
+RESPONSE_CACHE_THRESHOLD = float(os.getenv("RESPONSE_CACHE_THRESHOLD", "0.92"))
+
+# Redis Stack URL for sharing cached answers across workers (optional; each
+# process keeps its own in-memory cache without it)
+REDIS_URL = os.getenv("REDIS_URL")
+# Seconds a cached answer is kept, in Redis or in memory
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", "86400"))
+
+# =============================================================================
+# LOCAL CACHE
+# =============================================================================
+
+# On-disk caches (embeddings, MCP handshake, parsed data) live under backend/.cache
+CACHE_DIR = Path(os.getenv("CACHE_DIR", Path(__file__).resolve().parent.parent / ".cache"))
+
+# =============================================================================
+# KNOWLEDGE BASE (app/rag and app/tools)
+# =============================================================================
+
+# Source files live under backend/data (mounted at /app/data in Docker)
+DATA_DIR = Path(os.getenv("DATA_DIR", Path(__file__).resolve().parent.parent / "data"))
+
+# Documents indexed into the vector store: PDFs and Markdown/text files
+UNSTRUCTURED_DOCS = sorted(
+    path for path in (DATA_DIR / "docs").glob("*")
+    if path.suffix.lower() in {".pdf", ".md", ".txt"}
+)
+
+# CSV tables queried by the structured data tools
+STRUCTURED_DATA = {
+    name: DATA_DIR / "structured" / f"{name}.csv"
+    for name in ("pricing", "features", "support_issues")
+}
+
+CHROMA_PERSIST_DIR = Path(os.getenv("CHROMA_PERSIST_DIR", Path(__file__).resolve().parent.parent / "chroma_db"))
+CHUNK_SIZE = int(os.getenv("CHUNK_SIZE", "1000"))
+CHUNK_OVERLAP = int(os.getenv("CHUNK_OVERLAP", "200"))
+TOP_K_RESULTS = int(os.getenv("TOP_K_RESULTS", "4"))
 
 # =============================================================================
 # API CONFIGURATION
@@ -79,6 +122,10 @@ API_HOST = os.getenv("API_HOST", "0.0.0.0")
 # Cloud Run sets PORT, fallback to API_PORT or default to 8000
 API_PORT = int(os.getenv("PORT", os.getenv("API_PORT", "8000")))
 CORS_ORIGINS = os.getenv("CORS_ORIGINS", "http://localhost:3000,http://localhost:8000").split(",")
+# Worker processes; sessions live in process memory, so more than one needs sticky routing
+API_WORKERS = int(os.getenv("WEB_CONCURRENCY", "1"))
+# Auto-reload on code changes, for local development only
+API_RELOAD = os.getenv("DEV") == "1"
 
 # =============================================================================
 # OBSERVABILITY (Optional)
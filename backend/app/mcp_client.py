@@ -5,9 +5,107 @@ Client for connecting to MCP server using Streamable HTTP.
 """
 
 import json
+import threading
+import time
 import httpx
+import orjson
 from typing import Dict, Any, List, Optional
-from app.config import MCP_SERVER_URL
+from app.config import MCP_SERVER_URL, CACHE_DIR
+
+MCP_HEADERS = {
+    "Content-Type": "application/json",
+    "Accept": "application/json"
+}
+
+MCP_LIMITS = httpx.Limits(
+    max_connections=1000,
+    max_keepalive_connections=100,
+    keepalive_expiry=30.0
+)
+
+# Handshake result and tool list from the last process, reused on cold start
+MCP_INIT_CACHE_PATH = CACHE_DIR / "mcp_init.json"
+
+# Error code for calls that got no JSON-RPC reply (connection errors, timeouts,
+# HTTP error statuses); the server may or may not have processed the request
+LOCAL_ERROR_CODE = -1
+
+# Tools with side effects that must never be sent a second time
+NON_IDEMPOTENT_TOOLS = {"create_order"}
+
+MCP_INITIALIZE_PARAMS = {
+    "protocolVersion": "2024-11-05",
+    "capabilities": {},
+    "clientInfo": {
+        "name": "customer-support-agent",
+        "version": "1.0.0"
+    }
+}
+
+
+def _build_request(method: str, params: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Build a JSON-RPC request body."""
+    request = {
+        "jsonrpc": "2.0",
+        "id": 1,
+        "method": method
+    }
+    if params:
+        request["params"] = params
+    return request
+
+
+def _join_content(content: List[Any]) -> str:
+    """Join MCP content items (objects with type and text) into plain text."""
+    text_parts = []
+    for item in content:
+        if isinstance(item, dict):
+            text_parts.append(item.get("text", str(item)))
+        else:
+            text_parts.append(str(item))
+    return "\n".join(text_parts)
+
+
+def _is_session_error(result: Dict[str, Any]) -> bool:
+    """Check whether a call failed because the server doesn't know this client's session."""
+    error = result.get("error")
+    if not error:
+        return False
+    # Streamable HTTP servers answer 404 for a session they no longer hold
+    if error.get("http_status") == 404:
+        return True
+    if error.get("code") == LOCAL_ERROR_CODE:
+        return False
+    message = str(error.get("message", "")).lower()
+    return "not initialized" in message or "session" in message
+
+
+def _tool_result_text(tool_name: str, result: Dict[str, Any]) -> str:
+    """Turn a tools/call response into the text handed to the model."""
+    if "error" in result:
+        return f"Error calling {tool_name}: {result['error'].get('message', 'Unknown error')}"
+    
+    if "result" in result:
+        content = result["result"].get("content", [])
+        if content:
+            return _join_content(content)
+        return str(result["result"])
+    
+    return f"No result from {tool_name}"
+
+
+def _resource_result_text(uri: str, result: Dict[str, Any]) -> str:
+    """Turn a resources/read response into plain text."""
+    if "error" in result:
+        return f"Error reading resource {uri}: {result['error'].get('message', 'Unknown error')}"
+    
+    if "result" in result:
+        content = result["result"].get("contents", [])
+        if content:
+            return _join_content(content)
+        return str(result["result"])
+    
+    return f"No content from resource {uri}"
 
 
 class MCPClient:
@@ -17,44 +115,77 @@ class MCPClient:
         self.server_url = server_url
         self.client = httpx.Client(
             base_url=server_url,
-            headers={
-                "Content-Type": "application/json",
-                "Accept": "application/json"
-            },
-            timeout=30.0
+            headers=MCP_HEADERS,
+            timeout=30.0,
+            # One pooled HTTP/2 connection multiplexes concurrent JSON-RPC calls;
+            # retries only cover connection failures, so POSTs are never replayed
+            transport=httpx.HTTPTransport(http2=True, limits=MCP_LIMITS, retries=2)
         )
         self._initialized = False
+        self._cached_tools: Optional[List[Dict[str, Any]]] = None
+        # True while running on a handshake restored from disk rather than a live one
+        self._restored = False
+    
+    def load_init_cache(self) -> bool:
+        """Restore the handshake and tool list a previous process captured for this server."""
+        try:
+            data = json.loads(MCP_INIT_CACHE_PATH.read_text())
+        except (OSError, json.JSONDecodeError):
+            return False
+        
+        if (
+            data.get("server_url") != self.server_url
+            or data.get("protocol_version") != MCP_INITIALIZE_PARAMS["protocolVersion"]
+            or not data.get("tools")
+        ):
+            return False
+        
+        self._cached_tools = data["tools"]
+        self._initialized = True
+        self._restored = True
+        return True
+    
+    def _save_init_cache(self, tools: List[Dict[str, Any]]) -> None:
+        """Persist the tool list so the next process can skip the handshake."""
+        try:
+            MCP_INIT_CACHE_PATH.parent.mkdir(parents=True, exist_ok=True)
+            MCP_INIT_CACHE_PATH.write_text(json.dumps({
+                "server_url": self.server_url,
+                "protocol_version": MCP_INITIALIZE_PARAMS["protocolVersion"],
+                "tools": tools,
+                "captured_at": time.time()
+            }))
+        except OSError as e:
+            print(f"Could not write MCP init cache: {e}")
     
     def _call(self, method: str, params: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
         """Make an MCP JSON-RPC call."""
-        request = {
-            "jsonrpc": "2.0",
-            "id": 1,
-            "method": method
-        }
-        if params:
-            request["params"] = params
+        request = _build_request(method, params)
         
         try:
-            response = self.client.post("/mcp", json=request)
+            # The client's default headers already declare JSON
+            response = self.client.post("/mcp", content=orjson.dumps(request))
             response.raise_for_status()
-            return response.json()
-        except Exception as e:
-            return {"error": {"code": -1, "message": str(e)}}
+            return orjson.loads(response.content)
+        except httpx.HTTPStatusError as e:
+            error = {"code": LOCAL_ERROR_CODE, "message": str(e), "http_status": e.response.status_code}
+            # Keep the server's JSON-RPC error, if it sent one, so callers can tell why
+            try:
+                body_error = orjson.loads(e.response.content).get("error")
+            except (orjson.JSONDecodeError, AttributeError):
+                body_error = None
+            if isinstance(body_error, dict):
+                error.update(body_error)
+            return {"error": error}
+        except (httpx.HTTPError, orjson.JSONDecodeError) as e:
+            return {"error": {"code": LOCAL_ERROR_CODE, "message": str(e)}}
     
     def initialize(self) -> bool:
         """Initialize connection to MCP server."""
         if self._initialized:
             return True
         
-        result = self._call("initialize", {
-            "protocolVersion": "2024-11-05",
-            "capabilities": {},
-            "clientInfo": {
-                "name": "customer-support-agent",
-                "version": "1.0.0"
-            }
-        })
+        result = self._call("initialize", MCP_INITIALIZE_PARAMS)
         
         if "error" not in result:
             self._initialized = True
@@ -63,14 +194,32 @@ class MCPClient:
             return True
         return False
     
-    def list_tools(self) -> List[Dict[str, Any]]:
-        """List available tools from MCP server."""
+    def list_tools(self, refresh: bool = False) -> List[Dict[str, Any]]:
+        """List available tools from MCP server; refresh=True bypasses the cached list."""
+        if self._cached_tools is not None and not refresh:
+            return self._cached_tools
+        
         if not self._initialized:
             self.initialize()
         
         result = self._call("tools/list")
+        if self._restored:
+            if _is_session_error(result):
+                # The server doesn't hold the restored session; handshake for real
+                # and retry (listing has no side effects)
+                self._restored = False
+                self._initialized = False
+                if self.initialize():
+                    result = self._call("tools/list")
+            elif "error" not in result:
+                self._restored = False
+        
         if "result" in result and "tools" in result["result"]:
-            return result["result"]["tools"]
+            tools = result["result"]["tools"]
+            if tools and tools != self._cached_tools:
+                self._cached_tools = tools
+                self._save_init_cache(tools)
+            return tools
         return []
     
     def call_tool(self, tool_name: str, arguments: Optional[Dict[str, Any]] = None) -> str:
@@ -81,28 +230,29 @@ class MCPClient:
         if arguments is None:
             arguments = {}
         
-        result = self._call("tools/call", {
+        params = {
             "name": tool_name,
             "arguments": arguments
-        })
-        
-        if "error" in result:
-            return f"Error calling {tool_name}: {result['error'].get('message', 'Unknown error')}"
+        }
+        result = self._call("tools/call", params)
         
-        if "result" in result:
-            content = result["result"].get("content", [])
-            if content and len(content) > 0:
-                # MCP returns content as array of objects with type and text
-                text_parts = []
-                for item in content:
-                    if isinstance(item, dict):
-                        text_parts.append(item.get("text", str(item)))
-                    else:
-                        text_parts.append(str(item))
-                return "\n".join(text_parts)
-            return str(result["result"])
+        if self._restored:
+            if _is_session_error(result):
+                # The server rejected the restored session without running the
+                # tool: handshake for real, refresh the cached tool list and retry
+                # once, unless the tool has side effects
+                self._restored = False
+                self._initialized = False
+                self._cached_tools = None
+                if self.initialize():
+                    self.list_tools()
+                    if tool_name not in NON_IDEMPOTENT_TOOLS:
+                        result = self._call("tools/call", params)
+            elif "error" not in result:
+                # The restored session works; later errors are the server's own
+                self._restored = False
         
-        return f"No result from {tool_name}"
+        return _tool_result_text(tool_name, result)
     
     def list_resources(self) -> List[Dict[str, Any]]:
         """List available resources from MCP server."""
@@ -120,22 +270,7 @@ class MCPClient:
             self.initialize()
         
         result = self._call("resources/read", {"uri": uri})
-        if "error" in result:
-            return f"Error reading resource {uri}: {result['error'].get('message', 'Unknown error')}"
-        
-        if "result" in result:
-            content = result["result"].get("contents", [])
-            if content and len(content) > 0:
-                text_parts = []
-                for item in content:
-                    if isinstance(item, dict):
-                        text_parts.append(item.get("text", str(item)))
-                    else:
-                        text_parts.append(str(item))
-                return "\n".join(text_parts)
-            return str(result["result"])
-        
-        return f"No content from resource {uri}"
+        return _resource_result_text(uri, result)
     
     def close(self):
         """Close the client connection."""
@@ -145,13 +280,19 @@ class MCPClient:
 
 # Singleton instance
 _mcp_client: Optional[MCPClient] = None
+_mcp_client_lock = threading.Lock()
 
 
 def get_mcp_client() -> MCPClient:
     """Get or create the MCP client singleton."""
     global _mcp_client
     if _mcp_client is None:
-        _mcp_client = MCPClient()
-        _mcp_client.initialize()
+        with _mcp_client_lock:
+            if _mcp_client is None:
+                # Publish only once initialized so other threads never handshake twice
+                mcp_client = MCPClient()
+                if not mcp_client.load_init_cache():
+                    mcp_client.initialize()
+                _mcp_client = mcp_client
     return _mcp_client
 
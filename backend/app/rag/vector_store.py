@@ -4,20 +4,33 @@ RAG Vector Store Module
 Handles document loading, chunking, embedding, and retrieval.
 """
 
+import functools
 import hashlib
 import json
+import os
 import platform
+import re
+import sqlite3
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
-from typing import List, Optional
+from typing import TYPE_CHECKING, Dict, Iterator, List, Optional
 
-from langchain_community.document_loaders import (
-    TextLoader,
-    PyPDFLoader,
-)
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_openai import OpenAIEmbeddings
-from langchain_community.vectorstores import Chroma
-from langchain.schema import Document
+import numpy as np
+
+try:
+    # SIMD-accelerated; falls back to hashlib's blake2b when not installed
+    from blake3 import blake3 as _docs_hasher
+except ImportError:
+    _docs_hasher = hashlib.blake2b
+
+# langchain and chromadb are heavy; they're imported where first used so
+# importing this module doesn't slow down API startup
+if TYPE_CHECKING:
+    from langchain_community.vectorstores import Chroma
+    from langchain.schema import Document
 
 from app.config import (
     UNSTRUCTURED_DOCS,
@@ -27,29 +40,190 @@ from app.config import (
     CHROMA_PERSIST_DIR,
     OPENAI_API_KEY,
     EMBEDDING_MODEL,
+    CACHE_DIR,
 )
+from app.semantic_cache import SemanticCache
 
 IS_WINDOWS = platform.system() == "Windows"
 
+COLLECTION_NAME = "company_docs"
+# Texts per embeddings request; batches are embedded concurrently
+EMBED_BATCH_SIZE = 256
+EMBED_MAX_WORKERS = 8
+# Cosine space so relevance scores are 1 - distance; larger construction_ef/M
+# build a denser graph, search_ef trades a little latency for recall
+HNSW_METADATA = {
+    "hnsw:space": "cosine",
+    "hnsw:construction_ef": 200,
+    "hnsw:M": 32,
+    "hnsw:search_ef": 100,
+}
+DOCS_HASH_BLOCK_SIZE = 1 << 20
+EMBEDDING_CACHE_PATH = CACHE_DIR / "embeddings.sqlite"
+_WHITESPACE_RE = re.compile(r"\s+")
+# Keys per SELECT, kept under SQLite's bound-parameter limit
+_EMBEDDING_CACHE_QUERY_BATCH = 500
+
+
+class EmbeddingCache:
+    """SQLite-backed store of embedding vectors keyed by sha256(model, text)."""
+    
+    def __init__(self, path: Path = EMBEDDING_CACHE_PATH):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(path), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS emb (key BLOB PRIMARY KEY, vec BLOB NOT NULL)"
+        )
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def key(model: str, text: str) -> bytes:
+        return hashlib.sha256(f"{model}\0{text}".encode()).digest()
+    
+    def get_many(self, keys: List[bytes]) -> Dict[bytes, List[float]]:
+        """Return the cached vectors for whichever keys are present."""
+        found: Dict[bytes, List[float]] = {}
+        unique = list(dict.fromkeys(keys))
+        with self._lock:
+            for start in range(0, len(unique), _EMBEDDING_CACHE_QUERY_BATCH):
+                batch = unique[start:start + _EMBEDDING_CACHE_QUERY_BATCH]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT key, vec FROM emb WHERE key IN ({placeholders})", batch
+                )
+                for key, vec in rows:
+                    found[key] = np.frombuffer(vec, dtype=np.float32).tolist()
+        return found
+    
+    def put_many(self, items: Dict[bytes, List[float]]) -> None:
+        """Store vectors as float32 blobs."""
+        rows = [(key, np.asarray(vec, dtype=np.float32).tobytes()) for key, vec in items.items()]
+        with self._lock, self._conn:
+            self._conn.executemany("INSERT OR REPLACE INTO emb (key, vec) VALUES (?, ?)", rows)
+
+
+_embedding_cache: Optional[EmbeddingCache] = None
+_embedding_cache_lock = threading.Lock()
+
+
+def get_embedding_cache() -> EmbeddingCache:
+    """Get or create the on-disk embedding cache."""
+    global _embedding_cache
+    if _embedding_cache is None:
+        with _embedding_cache_lock:
+            if _embedding_cache is None:
+                _embedding_cache = EmbeddingCache()
+    return _embedding_cache
+
+
+class CachedEmbeddings:
+    """Wraps OpenAIEmbeddings, only calling the API for texts missing from the on-disk cache."""
+    
+    def __init__(self, api_key: Optional[str], model: str):
+        from langchain_openai import OpenAIEmbeddings
+
+        self.model = model
+        self._embeddings = OpenAIEmbeddings(api_key=api_key, model=model)
+    
+    def embed_documents(self, texts: List[str], *args, **kwargs) -> List[List[float]]:
+        cache = get_embedding_cache()
+        keys = [EmbeddingCache.key(self.model, text) for text in texts]
+        vectors = cache.get_many(keys)
+
+        missing = [i for i, key in enumerate(keys) if key not in vectors]
+        if missing:
+            fresh = self._embeddings.embed_documents([texts[i] for i in missing], *args, **kwargs)
+            new = {keys[i]: vector for i, vector in zip(missing, fresh)}
+            cache.put_many(new)
+            vectors.update(new)
+
+        return [vectors[key] for key in keys]
+    
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+
+@functools.lru_cache(maxsize=1)
+def _get_splitter():
+    """Build the shared text splitter once; it only depends on module constants."""
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+    return RecursiveCharacterTextSplitter(
+        chunk_size=CHUNK_SIZE,
+        chunk_overlap=CHUNK_OVERLAP,
+        separators=["\n## ", "\n### ", "\n\n", "\n", " ", ""],
+        is_separator_regex=False,
+    )
+
+
+def _load_pdf(path: str) -> List["Document"]:
+    """Parse a PDF into page Documents; runs in a worker process."""
+    from langchain_community.document_loaders import PyPDFLoader
+
+    return PyPDFLoader(path).load()
+
+
+class SearchResultCache:
+    """Two-tier cache of formatted search results: exact query hash, then embedding similarity."""
+
+    def __init__(self, threshold: float = 0.95, max_entries: int = 1024, quantize: bool = False):
+        self.max_entries = max_entries
+        self._exact: "OrderedDict[str, str]" = OrderedDict()
+        self._similar = SemanticCache(max_entries=max_entries, threshold=threshold, quantize=quantize)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(query: str) -> str:
+        return hashlib.sha256(query.encode()).hexdigest()
+
+    def get_exact(self, query: str) -> Optional[str]:
+        """Return the cached result for this exact query, if any."""
+        key = self._key(query)
+        with self._lock:
+            result = self._exact.get(key)
+            if result is not None:
+                self._exact.move_to_end(key)
+            return result
+
+    def get_similar(self, embedding: List[float]) -> Optional[str]:
+        """Return the cached result for the most similar query above the threshold."""
+        hits = self._similar.query(embedding)
+        return hits[0][1] if hits else None
+
+    def put(self, query: str, embedding: List[float], result: str) -> None:
+        """Cache a formatted result under both the exact query and its embedding."""
+        with self._lock:
+            self._exact[self._key(query)] = result
+            if len(self._exact) > self.max_entries:
+                self._exact.popitem(last=False)
+        self._similar.update(embedding, result)
+
+    def clear(self) -> None:
+        """Drop all cached results, e.g. after the index is rebuilt."""
+        with self._lock:
+            self._exact.clear()
+        self._similar.clear()
+
 
 class RAGVectorStore:
     """Manages the vector store for RAG-based retrieval."""
 
     def __init__(self):
-        self.embeddings = OpenAIEmbeddings(
+        self.embeddings = CachedEmbeddings(
             api_key=OPENAI_API_KEY,
             model=EMBEDDING_MODEL,
         )
-        self.text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=CHUNK_SIZE,
-            chunk_overlap=CHUNK_OVERLAP,
-            separators=["\n## ", "\n### ", "\n\n", "\n", " ", ""],
-        )
-        self.vector_store: Optional[Chroma] = None
+        self.text_splitter = _get_splitter()
+        self.vector_store: Optional["Chroma"] = None
+        # Per-document content hash and chunk_key -> Chroma id, used to diff between starts
         self._docs_hash_file = CHROMA_PERSIST_DIR / "docs_hash.json"
 
     def _get_loader(self, file_path: Path):
         """Get appropriate loader based on file extension."""
+        from langchain_community.document_loaders import PyPDFLoader, TextLoader
+
         suffix = file_path.suffix.lower()
 
         if suffix == ".pdf":
@@ -59,105 +233,205 @@ class RAGVectorStore:
             # TextLoader handles markdown files perfectly fine for RAG
             return TextLoader(str(file_path), encoding='utf-8')
 
-    def _compute_docs_hash(self) -> str:
-        """Compute hash of all document contents to detect changes."""
-        hasher = hashlib.md5()
-        for doc_path in sorted(UNSTRUCTURED_DOCS):
-            if doc_path.exists():
-                hasher.update(doc_path.read_bytes())
-                hasher.update(str(doc_path.stat().st_mtime).encode())
+    @staticmethod
+    def _hash_file(doc_path: Path) -> str:
+        """Hash a document's contents to detect changes."""
+        hasher = _docs_hasher()
+        # Stream in 1MB blocks so large PDFs aren't read into memory whole
+        with open(doc_path, "rb") as f:
+            for block in iter(lambda: f.read(DOCS_HASH_BLOCK_SIZE), b""):
+                hasher.update(block)
         return hasher.hexdigest()
 
-    def _should_rebuild_index(self) -> bool:
-        """Check if index needs rebuilding based on document changes."""
-        if not CHROMA_PERSIST_DIR.exists():
-            return True
-        if not self._docs_hash_file.exists():
-            return True
+    def _compute_docs_hashes(self) -> Dict[str, str]:
+        """Hash every configured document that exists, keyed by path."""
+        return {
+            str(doc_path): self._hash_file(doc_path)
+            for doc_path in UNSTRUCTURED_DOCS
+            if doc_path.exists()
+        }
 
-        current_hash = self._compute_docs_hash()
+    def _load_docs_state(self) -> Dict[str, dict]:
+        """Load the per-document {hash, chunks: {chunk_key: id}} of the persisted collection."""
         try:
-            stored_hash = json.loads(self._docs_hash_file.read_text()).get("hash")
-            return current_hash != stored_hash
-        except (json.JSONDecodeError, KeyError):
-            return True
+            return json.loads(self._docs_hash_file.read_text()).get("docs", {})
+        except (FileNotFoundError, json.JSONDecodeError, AttributeError):
+            return {}
 
-    def _save_docs_hash(self):
-        """Save current documents hash."""
+    def _save_docs_state(self, state: Dict[str, dict]) -> None:
+        """Save the per-document hashes and chunk ids."""
         CHROMA_PERSIST_DIR.mkdir(parents=True, exist_ok=True)
-        self._docs_hash_file.write_text(
-            json.dumps({"hash": self._compute_docs_hash()})
-        )
-
-    def load_documents(self) -> List[Document]:
-        """Load all configured documents."""
-        all_docs = []
-
-        for doc_path in UNSTRUCTURED_DOCS:
-            if not doc_path.exists():
+        self._docs_hash_file.write_text(json.dumps({"docs": state}))
+
+    @staticmethod
+    def _chunk_key(chunk: "Document") -> str:
+        """Key a chunk by its source file and whitespace/case-normalized text."""
+        normalized = _WHITESPACE_RE.sub(" ", chunk.page_content).strip().lower()
+        source = chunk.metadata.get("source_file", "")
+        return hashlib.sha256(f"{source}\0{normalized}".encode()).hexdigest()
+
+    def iter_documents(self, paths: Optional[List[Path]] = None) -> Iterator["Document"]:
+        """Lazily yield documents (one per PDF page) from the given or all configured files."""
+        doc_paths = []
+        for doc_path in UNSTRUCTURED_DOCS if paths is None else paths:
+            if doc_path.exists():
+                doc_paths.append(doc_path)
+            else:
                 print(f"Warning: Document not found: {doc_path}")
-                continue
-
-            try:
-                loader = self._get_loader(doc_path)
-                docs = loader.load()
-
-                for doc in docs:
-                    doc.metadata["source_file"] = doc_path.name
-
-                all_docs.extend(docs)
-                print(f"Loaded: {doc_path.name} ({len(docs)} documents)")
 
-            except Exception as e:
-                print(f"Error loading {doc_path}: {e}")
+        # pypdf is pure Python, so several PDFs only parse in parallel across
+        # processes; a single PDF is streamed page by page in-process instead
+        pdf_paths = [p for p in doc_paths if p.suffix.lower() == ".pdf"]
+        executor: Optional[ProcessPoolExecutor] = None
+        futures: Dict[Path, Future] = {}
+        if len(pdf_paths) > 1:
+            executor = ProcessPoolExecutor(max_workers=min(len(pdf_paths), os.cpu_count() or 1))
+            futures = {p: executor.submit(_load_pdf, str(p)) for p in pdf_paths}
 
-        return all_docs
+        try:
+            for doc_path in doc_paths:
+                try:
+                    if doc_path in futures:
+                        docs = futures[doc_path].result()
+                    else:
+                        docs = self._get_loader(doc_path).lazy_load()
+                    count = 0
+                    for doc in docs:
+                        doc.metadata["source_file"] = doc_path.name
+                        count += 1
+                        yield doc
+                    print(f"Loaded: {doc_path.name} ({count} documents)")
+
+                except Exception as e:
+                    print(f"Error loading {doc_path}: {e}")
+        finally:
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+
+    def load_documents(self) -> List["Document"]:
+        """Load all configured documents."""
+        return list(self.iter_documents())
+
+    def _embed_texts(self, texts: List[str]) -> List[List[float]]:
+        """Embed texts in batches, sending the batch requests concurrently."""
+        batches = [texts[i:i + EMBED_BATCH_SIZE] for i in range(0, len(texts), EMBED_BATCH_SIZE)]
+        if len(batches) <= 1:
+            return self.embeddings.embed_documents(texts) if texts else []
+
+        with ThreadPoolExecutor(max_workers=min(EMBED_MAX_WORKERS, len(batches))) as executor:
+            results = executor.map(self.embeddings.embed_documents, batches)
+        return [embedding for batch in results for embedding in batch]
+
+    def _open_collection(self) -> "Chroma":
+        """Open the persisted collection, creating it with the tuned HNSW settings."""
+        from langchain_community.vectorstores import Chroma
+
+        return Chroma(
+            persist_directory=str(CHROMA_PERSIST_DIR.resolve()),
+            embedding_function=self.embeddings,
+            collection_name=COLLECTION_NAME,
+            collection_metadata=HNSW_METADATA,
+        )
 
     def initialize(self, force_rebuild: bool = False) -> None:
-        """Initialize or load the vector store."""
+        """Initialize or load the vector store, re-indexing only documents that changed."""
         CHROMA_PERSIST_DIR.mkdir(parents=True, exist_ok=True)
-        persist_dir_str = str(CHROMA_PERSIST_DIR.resolve())
-
-        if not force_rebuild and not self._should_rebuild_index():
-            print("Loading existing vector store...")
-            self.vector_store = Chroma(
-                persist_directory=persist_dir_str,
-                embedding_function=self.embeddings,
-                collection_name="company_docs",
-            )
-            print(f"Loaded vector store with {self.vector_store._collection.count()} chunks")
-            return
 
-        print("Building vector store from documents...")
+        self.vector_store = self._open_collection()
+        metadata = self.vector_store._collection.metadata or {}
+        if metadata.get("hnsw:space") != HNSW_METADATA["hnsw:space"]:
+            # Collections built before the cosine switch can't be reused
+            force_rebuild = True
 
-        documents = self.load_documents()
-        if not documents:
+        current = self._compute_docs_hashes()
+        if not current:
             raise ValueError("No documents loaded. Check UNSTRUCTURED_DOCS paths.")
 
-        chunks = self.text_splitter.split_documents(documents)
-        print(f"Created {len(chunks)} chunks from {len(documents)} documents")
+        previous = {} if force_rebuild else self._load_docs_state()
+        indexed = sum(len(entry["chunks"]) for entry in previous.values())
+        if force_rebuild or indexed != self.vector_store._collection.count():
+            # The stored state doesn't describe this collection; start from
+            # empty so a rebuild doesn't duplicate chunks
+            self.vector_store.delete_collection()
+            self.vector_store = self._open_collection()
+            previous = {}
+
+        changed = [path for path, digest in current.items() if previous.get(path, {}).get("hash") != digest]
+        removed = [path for path in previous if path not in current]
+        if not changed and not removed:
+            print(f"Loaded vector store with {self.vector_store._collection.count()} chunks")
+            return
 
-        self.vector_store = Chroma.from_documents(
-            documents=chunks,
-            embedding=self.embeddings,
-            persist_directory=persist_dir_str,
-            collection_name="company_docs",
-        )
+        print(f"Updating vector store: {len(changed)} changed, {len(removed)} removed documents...")
+        state = {path: previous[path] for path in current if path not in changed}
+        stale_ids = [chunk_id for path in removed for chunk_id in previous[path]["chunks"].values()]
+
+        # Only changed documents are loaded and split; pages stream into the splitter
+        chunks = self.text_splitter.split_documents(self.iter_documents([Path(p) for p in changed]))
+        chunks_by_doc: Dict[str, Dict[str, "Document"]] = {}
+        for chunk in chunks:
+            # Identical normalized chunks from the same file are stored once
+            chunks_by_doc.setdefault(chunk.metadata["source"], {}).setdefault(self._chunk_key(chunk), chunk)
+
+        added: List[tuple] = []
+        for path in changed:
+            old_chunks = previous.get(path, {}).get("chunks", {})
+            new_chunks = chunks_by_doc.get(path, {})
+            if not new_chunks:
+                # Failed to load: keep its previous vectors and state (with the old
+                # hash) so search still finds it and the next start retries it
+                if path in previous:
+                    state[path] = previous[path]
+                continue
+            stale_ids.extend(chunk_id for key, chunk_id in old_chunks.items() if key not in new_chunks)
+            state[path] = {
+                "hash": current[path],
+                "chunks": {key: old_chunks[key] for key in new_chunks if key in old_chunks},
+            }
+            # Within a changed document, chunks that only differ in case or whitespace are kept
+            added.extend((path, key, chunk) for key, chunk in new_chunks.items() if key not in old_chunks)
+
+        if stale_ids:
+            self.vector_store._collection.delete(ids=stale_ids)
+
+        texts = [chunk.page_content for _, _, chunk in added]
+        embeddings = self._embed_texts(texts)
+        added_ids = [str(uuid.uuid4()) for _ in added]
+        for start in range(0, len(added), EMBED_BATCH_SIZE):
+            end = start + EMBED_BATCH_SIZE
+            self.vector_store._collection.add(
+                ids=added_ids[start:end],
+                embeddings=embeddings[start:end],
+                metadatas=[chunk.metadata for _, _, chunk in added[start:end]],
+                documents=texts[start:end],
+            )
+        for (path, key, _), chunk_id in zip(added, added_ids):
+            state[path]["chunks"][key] = chunk_id
 
-        self._save_docs_hash()
-        print("Vector store built and persisted successfully")
+        self._save_docs_state(state)
+        _search_cache.clear()
+        print(f"Vector store updated: {len(added)} chunks added, {len(stale_ids)} removed")
 
-    def search(self, query: str, k: int = TOP_K_RESULTS) -> List[Document]:
+    def search(self, query: str, k: int = TOP_K_RESULTS) -> List["Document"]:
         """Search for relevant documents."""
         if not self.vector_store:
             raise RuntimeError("Vector store not initialized. Call initialize() first.")
         return self.vector_store.similarity_search(query, k=k)
 
     def search_with_scores(self, query: str, k: int = TOP_K_RESULTS) -> List[tuple]:
-        """Search for relevant documents with similarity scores."""
+        """Search for relevant documents with relevance scores in [0, 1], higher is better."""
+        if not self.vector_store:
+            raise RuntimeError("Vector store not initialized. Call initialize() first.")
+        return self.vector_store.similarity_search_with_relevance_scores(query, k=k)
+
+    def search_by_vector_with_scores(self, embedding: List[float], k: int = TOP_K_RESULTS) -> List[tuple]:
+        """Search with a precomputed query embedding; scores match search_with_scores."""
         if not self.vector_store:
             raise RuntimeError("Vector store not initialized. Call initialize() first.")
-        return self.vector_store.similarity_search_with_score(query, k=k)
+        # Chroma returns raw distances here; convert them the same way search_with_scores does
+        to_relevance = self.vector_store._select_relevance_score_fn()
+        results = self.vector_store.similarity_search_by_vector_with_relevance_scores(embedding, k=k)
+        return [(doc, to_relevance(distance)) for doc, distance in results]
 
     def get_retriever(self):
         """Get a retriever interface for the vector store."""
@@ -171,14 +445,20 @@ class RAGVectorStore:
 
 # Singleton instance
 _vector_store: Optional[RAGVectorStore] = None
+_vector_store_lock = threading.Lock()
+_search_cache = SearchResultCache()
 
 
 def get_vector_store() -> RAGVectorStore:
     """Get or create the vector store singleton."""
     global _vector_store
     if _vector_store is None:
-        _vector_store = RAGVectorStore()
-        _vector_store.initialize()
+        with _vector_store_lock:
+            if _vector_store is None:
+                # Publish only once initialized so other threads never see a half-built store
+                vector_store = RAGVectorStore()
+                vector_store.initialize()
+                _vector_store = vector_store
     return _vector_store
 
 
@@ -187,8 +467,18 @@ def search_knowledge_base(query: str) -> str:
     Search the company knowledge base for relevant information.
     This function is designed to be used as a tool by the agent.
     """
+    cached = _search_cache.get_exact(query)
+    if cached is not None:
+        return cached
+
     vs = get_vector_store()
-    results = vs.search_with_scores(query)
+    # Embed once: the same vector serves the similarity lookup and the search
+    embedding = vs.embeddings.embed_query(query)
+    cached = _search_cache.get_similar(embedding)
+    if cached is not None:
+        return cached
+
+    results = vs.search_by_vector_with_scores(embedding)
 
     if not results:
         return "No relevant information found in the knowledge base."
@@ -196,9 +486,11 @@ def search_knowledge_base(query: str) -> str:
     formatted_results = []
     for doc, score in results:
         source = doc.metadata.get("source_file", "Unknown")
-        relevance = "High" if score < 0.5 else "Medium" if score < 1.0 else "Low"
+        relevance = "High" if score > 0.75 else "Medium" if score > 0.5 else "Low"
         formatted_results.append(
             f"[Source: {source} | Relevance: {relevance}]\n{doc.page_content}"
         )
 
-    return "\n\n---\n\n".join(formatted_results)
+    formatted = "\n\n---\n\n".join(formatted_results)
+    _search_cache.put(query, embedding, formatted)
+    return formatted
@@ -0,0 +1,304 @@
+"""
+Semantic Cache
+==============
+Caches of payloads keyed on text embeddings: a bounded in-memory cache per
+process, and a Redis-backed one shared by every worker.
+"""
+
+import hashlib
+import threading
+import time
+from typing import Any, List, Optional, Set, Tuple
+
+import numpy as np
+import orjson
+
+try:
+    import redis
+except ImportError:  # Only needed when REDIS_URL is set
+    redis = None
+
+
+class SemanticCache:
+    """Fixed-size cache returning payloads whose embeddings are close to a query embedding.
+
+    With a `ttl`, entries also expire that many seconds after they are stored.
+    """
+
+    def __init__(
+        self,
+        dim: Optional[int] = None,
+        max_entries: int = 1024,
+        threshold: float = 0.88,
+        quantize: bool = False,
+        ttl: Optional[float] = None,
+    ):
+        self.dim = dim
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self.ttl = ttl
+        # int8 rows with a per-row scale use a quarter of the float32 memory
+        self.quantize = quantize
+        # One contiguous (max_entries, dim) block of L2-normalized rows, so a
+        # lookup is a single matrix-vector product
+        self._vectors: Optional[np.ndarray] = None
+        self._scales: Optional[np.ndarray] = None  # (max_entries,) int8 dequantization scales
+        self._valid = np.zeros(max_entries, dtype=bool)
+        self._expires = np.full(max_entries, np.inf)  # time.monotonic() deadline per slot
+        self._payloads: List[Any] = [None] * max_entries
+        self._next = 0  # Slot overwritten by the next update, i.e. the oldest entry
+        self._lock = threading.Lock()
+        if dim is not None:
+            self._allocate(dim)
+
+    def _allocate(self, dim: int) -> None:
+        self.dim = dim
+        self._vectors = np.zeros((self.max_entries, dim), dtype=np.int8 if self.quantize else np.float32)
+        if self.quantize:
+            self._scales = np.zeros(self.max_entries, dtype=np.float32)
+
+    @staticmethod
+    def _normalize(vector: List[float]) -> Optional[np.ndarray]:
+        v = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(v)
+        return v / norm if norm else None
+
+    @staticmethod
+    def _quantize(v: np.ndarray) -> Tuple[np.ndarray, float]:
+        scale = float(np.abs(v).max()) / 127 or 1.0
+        return np.round(v / scale).astype(np.int8), scale
+
+    def _expire(self) -> None:
+        """Invalidate entries past their TTL."""
+        expired = self._valid & (self._expires <= time.monotonic())
+        if expired.any():
+            for i in np.flatnonzero(expired):
+                self._payloads[i] = None
+            self._valid[expired] = False
+
+    def _similarities(self, v: np.ndarray) -> np.ndarray:
+        """Cosine similarity to every slot; empty, invalidated or expired slots score -inf."""
+        self._expire()
+        if self.quantize:
+            v_i8, v_scale = self._quantize(v)
+            # int32 accumulation: int16 would overflow over ~1.5k dimensions
+            dots = self._vectors.astype(np.int32) @ v_i8.astype(np.int32)
+            similarities = dots * self._scales * v_scale
+        else:
+            similarities = self._vectors @ v
+        similarities[~self._valid] = -np.inf
+        return similarities
+
+    def query(self, vector: List[float], M: int = 1) -> List[Tuple[float, Any]]:
+        """Return up to M (similarity, payload) pairs at or above the threshold, best first."""
+        v = self._normalize(vector)
+        with self._lock:
+            if v is None or self._vectors is None or v.shape[0] != self.dim:
+                return []
+            similarities = self._similarities(v)
+            if M == 1:
+                top = [int(np.argmax(similarities))]
+            else:
+                top = np.argsort(similarities)[::-1][:M]
+            return [
+                (float(similarities[i]), self._payloads[i])
+                for i in top
+                if similarities[i] >= self.threshold
+            ]
+
+    def update(self, vector: List[float], payload: Any) -> None:
+        """Store a payload under the given embedding, evicting the oldest entry when full."""
+        v = self._normalize(vector)
+        if v is None:
+            return
+        with self._lock:
+            if self._vectors is None:
+                self._allocate(v.shape[0])
+            elif v.shape[0] != self.dim:
+                return
+            slot = self._next
+            if self.quantize:
+                self._vectors[slot], self._scales[slot] = self._quantize(v)
+            else:
+                self._vectors[slot] = v
+            self._payloads[slot] = payload
+            self._valid[slot] = True
+            self._expires[slot] = time.monotonic() + self.ttl if self.ttl else np.inf
+            self._next = (slot + 1) % self.max_entries
+
+    def invalidate(self, vector: List[float], threshold: float) -> int:
+        """Drop every entry within `threshold` cosine similarity of the vector; returns the count."""
+        v = self._normalize(vector)
+        with self._lock:
+            if v is None or self._vectors is None or v.shape[0] != self.dim:
+                return 0
+            stale = self._similarities(v) >= threshold
+            for i in np.flatnonzero(stale):
+                self._payloads[i] = None
+            self._valid[stale] = False
+            return int(stale.sum())
+
+    def clear(self) -> int:
+        """Drop all entries; returns how many there were."""
+        with self._lock:
+            self._expire()
+            count = int(self._valid.sum())
+            self._valid[:] = False
+            self._payloads = [None] * self.max_entries
+            self._next = 0
+            return count
+
+    def __len__(self) -> int:
+        with self._lock:
+            self._expire()
+            return int(self._valid.sum())
+
+
+class RedisSemanticCache:
+    """Semantic cache shared across workers, stored in Redis Stack with an HNSW vector index.
+
+    Mirrors SemanticCache, but payloads must be JSON-serializable and entries
+    expire after `ttl` seconds instead of being evicted by count.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        threshold: float = 0.88,
+        ttl: int = 86400,
+        prefix: str = "semcache:",
+        max_connections: int = 64,
+    ):
+        if redis is None:
+            raise ImportError("REDIS_URL is set but the redis package is not installed")
+        self.threshold = threshold
+        self.ttl = ttl
+        self.prefix = prefix
+        # Agent turns run on a thread pool; a blocking pool makes them wait for a
+        # free connection instead of failing when all are in use
+        self.client = redis.Redis(connection_pool=redis.BlockingConnectionPool.from_url(
+            url, max_connections=max_connections, timeout=5
+        ))
+        self._indexed: Set[int] = set()
+
+    # Embedding models differ in dimension, so each dimension gets its own key
+    # prefix and index rather than mixing incomparable vectors
+    def _index_name(self, dim: int) -> str:
+        return f"{self.prefix}idx:{dim}"
+
+    def _key_prefix(self, dim: int) -> str:
+        return f"{self.prefix}{dim}:"
+
+    @staticmethod
+    def _encode(vector: List[float]) -> Optional[bytes]:
+        v = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(v)
+        return (v / norm).tobytes() if norm else None
+
+    def _ensure_index(self, dim: int) -> None:
+        """Create the vector index for this dimension unless it already exists."""
+        if dim in self._indexed:
+            return
+        try:
+            self.client.execute_command(
+                "FT.CREATE", self._index_name(dim),
+                "ON", "HASH", "PREFIX", 1, self._key_prefix(dim),
+                "SCHEMA", "vector", "VECTOR", "HNSW", 6,
+                "TYPE", "FLOAT32", "DIM", dim, "DISTANCE_METRIC", "COSINE",
+            )
+        except redis.ResponseError as e:
+            if "already exists" not in str(e):
+                raise
+        self._indexed.add(dim)
+
+    def query(self, vector: List[float], M: int = 1) -> List[Tuple[float, Any]]:
+        """Return up to M (similarity, payload) pairs at or above the threshold, best first."""
+        blob = self._encode(vector)
+        if blob is None:
+            return []
+        try:
+            self._ensure_index(len(vector))
+            reply = self.client.execute_command(
+                "FT.SEARCH", self._index_name(len(vector)),
+                f"*=>[KNN {M} @vector $vec AS distance]",
+                "PARAMS", 2, "vec", blob,
+                "SORTBY", "distance",
+                "RETURN", 2, "distance", "payload",
+                "DIALECT", 2,
+            )
+        except redis.RedisError as e:
+            print(f"Semantic cache lookup failed: {e}")
+            return []
+        hits = []
+        # Reply: [total, key, [field, value, ...], key, [...], ...]
+        for fields in reply[2::2]:
+            values = dict(zip(fields[::2], fields[1::2]))
+            similarity = 1.0 - float(values[b"distance"])
+            if similarity >= self.threshold:
+                hits.append((similarity, orjson.loads(values[b"payload"])))
+        return hits
+
+    def update(self, vector: List[float], payload: Any) -> None:
+        """Store a payload under the given embedding, expiring after the TTL."""
+        blob = self._encode(vector)
+        if blob is None:
+            return
+        dim = len(vector)
+        key = self._key_prefix(dim) + hashlib.sha1(blob).hexdigest()
+        try:
+            self._ensure_index(dim)
+            # HSET and EXPIRE in one round trip
+            pipe = self.client.pipeline(transaction=False)
+            pipe.hset(key, mapping={"vector": blob, "payload": orjson.dumps(payload)})
+            pipe.expire(key, self.ttl)
+            pipe.execute()
+        except redis.RedisError as e:
+            print(f"Semantic cache update failed: {e}")
+
+    def invalidate(self, vector: List[float], threshold: float) -> int:
+        """Drop every entry within `threshold` cosine similarity of the vector; returns the count."""
+        blob = self._encode(vector)
+        if blob is None:
+            return 0
+        try:
+            self._ensure_index(len(vector))
+            reply = self.client.execute_command(
+                "FT.SEARCH", self._index_name(len(vector)),
+                "@vector:[VECTOR_RANGE $radius $vec]",
+                "PARAMS", 4, "radius", 1.0 - threshold, "vec", blob,
+                "NOCONTENT", "LIMIT", 0, 10000,
+                "DIALECT", 2,
+            )
+            keys = reply[1:]
+            if keys:
+                self.client.unlink(*keys)
+        except redis.RedisError as e:
+            print(f"Semantic cache invalidation failed: {e}")
+            return 0
+        return len(keys)
+
+    def _scan_keys(self):
+        # Index names aren't keys, so every match is a cache entry
+        return self.client.scan_iter(match=f"{self.prefix}*", count=1000)
+
+    def clear(self) -> int:
+        """Drop all entries; returns how many there were."""
+        count = 0
+        batch = []
+        try:
+            for key in self._scan_keys():
+                batch.append(key)
+                if len(batch) == 500:
+                    count += self.client.unlink(*batch)
+                    batch = []
+            if batch:
+                count += self.client.unlink(*batch)
+        except redis.RedisError as e:
+            print(f"Semantic cache clear failed: {e}")
+        return count
+
+    def __len__(self) -> int:
+        try:
+            return sum(1 for _ in self._scan_keys())
+        except redis.RedisError:
+            return 0
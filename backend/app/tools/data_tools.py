@@ -4,45 +4,211 @@ Data Tools Module
 Tools for querying structured data (CSV files) with exact lookups.
 """
 
-import pandas as pd
-from typing import Optional, Dict
+import pickle
+import re
+import threading
+from collections import defaultdict
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Optional, Dict, List, Set
+
+from app.config import STRUCTURED_DATA, CACHE_DIR
+
+# pandas is imported on first load so importing this module stays cheap
+if TYPE_CHECKING:
+    import pandas as pd
+
+# Text columns matched case-insensitively by the tools; a lowercased copy of
+# each is stored alongside as "_<column>_lc" so queries don't re-lower them
+_LOWERCASE_COLUMNS = {
+    "pricing": ["plan_name"],
+    "features": ["feature_name", "description"],
+    "support_issues": ["issue_title", "category"],
+}
+
+_TOKEN_RE = re.compile(r"\w+")
+
+# Parsed tables plus their derived records and indexes, keyed by the CSV's
+# mtime and size; bump the version when the cached structures change shape
+CSV_CACHE_DIR = CACHE_DIR / "csv"
+_CSV_CACHE_VERSION = 1
+
+
+def _format_plan_info(row: Dict[str, Any]) -> str:
+    """Render a pricing row as the markdown block returned by get_pricing_info."""
+    return f"""
+**{row['plan_name']} Plan**
+- Monthly: ${row['monthly_price_usd']}/month
+- Annual: ${row['annual_price_usd']}/year (${row['annual_monthly_equivalent']}/month equivalent)
+- Users: {row['max_users']}
+- Storage: {row['storage_gb']}GB
+- Projects: {row['projects_limit']}
+- Custom Fields: {row['custom_fields']}
+- Time Tracking: {row['time_tracking']}
+- Priority Support: {row['priority_support']}
+- SSO: {row['sso']}
+    """.strip()
 
-from app.config import STRUCTURED_DATA
+
+def _format_plan_summary(row: Dict[str, Any]) -> str:
+    """Render a pricing row as a one-line list_all_plans entry."""
+    price_str = f"${row['monthly_price_usd']}/mo" if row['monthly_price_usd'] != "Custom" else "Custom pricing"
+    return f"- **{row['plan_name']}**: {price_str} - Up to {row['max_users']} users"
 
 
 class DataTools:
     """Collection of tools for structured data access."""
 
     def __init__(self):
-        self._dataframes: Dict[str, pd.DataFrame] = {}
+        self._dataframes: Dict[str, "pd.DataFrame"] = {}
+        # Rows as plain dicts, so the tools never box rows into pandas Series
+        self._records: Dict[str, List[Dict[str, Any]]] = {}
+        self._pricing_by_plan: Dict[str, Dict[str, Any]] = {}
+        # table -> column -> token -> ids of the records containing it
+        self._inv_idx: Dict[str, Dict[str, Dict[str, Set[int]]]] = {}
+        # Pricing responses rendered once per load; the data doesn't change between calls
+        self._plan_info: Dict[str, str] = {}
+        self._pricing_full_text: Optional[str] = None
+        self._plans_summary: Optional[str] = None
+        self._available_plans = ""
         self._load_data()
 
     def _load_data(self):
         """Load all structured data files."""
+        import pandas as pd
+
         for name, path in STRUCTURED_DATA.items():
             if path.exists():
                 try:
-                    self._dataframes[name] = pd.read_csv(path)
+                    cache_path = self._csv_cache_path(name, path)
+                    if not self._load_cached_table(name, cache_path):
+                        df = pd.read_csv(path)
+                        for col in _LOWERCASE_COLUMNS.get(name, []):
+                            df[f"_{col}_lc"] = df[col].fillna("").astype(str).str.lower()
+                        self._dataframes[name] = df
+                        self._records[name] = df.to_dict("records")
+                        self._inv_idx[name] = self._build_inverted_index(name)
+                        self._save_cached_table(name, cache_path)
                     print(f"Loaded structured data: {name} ({len(self._dataframes[name])} rows)")
                 except Exception as e:
                     print(f"Error loading {name}: {e}")
             else:
                 print(f"Warning: Data file not found: {path}")
 
+        pricing = self._records.get("pricing")
+        if pricing is not None:
+            self._pricing_by_plan = {row["_plan_name_lc"]: row for row in pricing}
+            self._plan_info = {
+                plan: _format_plan_info(row) for plan, row in self._pricing_by_plan.items()
+            }
+            self._pricing_full_text = "\n\n".join(_format_plan_info(row) for row in pricing)
+            self._plans_summary = "**Available Plans:**\n" + "\n".join(
+                _format_plan_summary(row) for row in pricing
+            )
+            self._available_plans = ", ".join(row["plan_name"] for row in pricing)
+
+    @staticmethod
+    def _csv_cache_path(name: str, path: Path) -> Path:
+        stat = path.stat()
+        return CSV_CACHE_DIR / f"{name}-{stat.st_mtime_ns}-{stat.st_size}-v{_CSV_CACHE_VERSION}.pkl"
+
+    def _load_cached_table(self, name: str, cache_path: Path) -> bool:
+        """Restore a table and its derived structures from the parse cache."""
+        try:
+            with open(cache_path, "rb") as f:
+                df, records, inv_idx = pickle.load(f)
+        except FileNotFoundError:
+            return False
+        except Exception as e:
+            print(f"Ignoring unreadable cache for {name}: {e}")
+            return False
+
+        self._dataframes[name] = df
+        self._records[name] = records
+        self._inv_idx[name] = inv_idx
+        return True
+
+    def _save_cached_table(self, name: str, cache_path: Path) -> None:
+        """Write a parsed table to the cache, replacing entries for older versions of the file."""
+        try:
+            CSV_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+            for stale in CSV_CACHE_DIR.glob(f"{name}-*.pkl"):
+                stale.unlink()
+            tmp_path = cache_path.with_suffix(".tmp")
+            with open(tmp_path, "wb") as f:
+                pickle.dump(
+                    (self._dataframes[name], self._records[name], self._inv_idx[name]),
+                    f,
+                    protocol=pickle.HIGHEST_PROTOCOL,
+                )
+            tmp_path.replace(cache_path)
+        except OSError as e:
+            print(f"Could not cache parsed {name}: {e}")
+
+    def _build_inverted_index(self, name: str) -> Dict[str, Dict[str, Set[int]]]:
+        """Map each token of the searchable columns to the records containing it."""
+        index: Dict[str, Dict[str, Set[int]]] = {}
+        for col in _LOWERCASE_COLUMNS.get(name, []):
+            postings: Dict[str, Set[int]] = defaultdict(set)
+            for row_id, row in enumerate(self._records[name]):
+                for token in _TOKEN_RE.findall(row[f"_{col}_lc"]):
+                    postings[token].add(row_id)
+            index[col] = dict(postings)
+        return index
+
+    def search(self, name: str, columns: List[str], keyword: str) -> List[Dict[str, Any]]:
+        """Records of `name` where any of `columns` contains `keyword`, or every word of it."""
+        records = self._records.get(name, [])
+        keyword = keyword.lower()
+        tokens = _TOKEN_RE.findall(keyword)
+
+        if not tokens:
+            # Nothing to look up in the index (e.g. punctuation only)
+            return [
+                row for row in records
+                if any(keyword in row[f"_{col}_lc"] for col in columns)
+            ]
+
+        hits: Set[int] = set()
+        for col in columns:
+            postings = self._inv_idx[name][col]
+            # Rows with every word of the keyword
+            hits |= set.intersection(*(postings.get(token, set()) for token in tokens))
+            # Any row containing the keyword as a substring ("log" in "login") has
+            # each of its words inside one of the row's words; scan the column's
+            # vocabulary rather than every row for those candidates, then confirm
+            candidates = set.intersection(*(
+                set().union(*(ids for word, ids in postings.items() if token in word))
+                for token in tokens
+            ))
+            key = f"_{col}_lc"
+            hits |= {row_id for row_id in candidates if keyword in records[row_id][key]}
+
+        return [records[row_id] for row_id in sorted(hits)]
+
     def reload_data(self):
         """Reload all data files."""
         self._dataframes.clear()
+        self._records.clear()
+        self._inv_idx.clear()
+        self._pricing_by_plan = {}
+        self._plan_info = {}
+        self._pricing_full_text = None
+        self._plans_summary = None
+        self._available_plans = ""
         self._load_data()
 
 
 _data_tools: Optional[DataTools] = None
+_data_tools_lock = threading.Lock()
 
 
 def get_data_tools() -> DataTools:
     """Get or create the data tools singleton."""
     global _data_tools
     if _data_tools is None:
-        _data_tools = DataTools()
+        with _data_tools_lock:
+            if _data_tools is None:
+                _data_tools = DataTools()
     return _data_tools
 
 
@@ -53,56 +219,34 @@ def get_data_tools() -> DataTools:
 def get_pricing_info(plan_name: Optional[str] = None) -> str:
     """Get pricing information for subscription plans."""
     tools = get_data_tools()
-    df = tools._dataframes.get("pricing")
 
-    if df is None:
+    if tools._pricing_full_text is None:
         return "Pricing information is currently unavailable."
 
     if plan_name:
-        plan_df = df[df["plan_name"].str.lower() == plan_name.lower()]
-        if plan_df.empty:
-            available = ", ".join(df["plan_name"].tolist())
-            return f"Plan '{plan_name}' not found. Available plans: {available}"
-        df = plan_df
-
-    results = []
-    for _, row in df.iterrows():
-        plan_info = f"""
-**{row['plan_name']} Plan**
-- Monthly: ${row['monthly_price_usd']}/month
-- Annual: ${row['annual_price_usd']}/year (${row['annual_monthly_equivalent']}/month equivalent)
-- Users: {row['max_users']}
-- Storage: {row['storage_gb']}GB
-- Projects: {row['projects_limit']}
-- Custom Fields: {row['custom_fields']}
-- Time Tracking: {row['time_tracking']}
-- Priority Support: {row['priority_support']}
-- SSO: {row['sso']}
-        """.strip()
-        results.append(plan_info)
+        plan_info = tools._plan_info.get(plan_name.lower())
+        if plan_info is None:
+            return f"Plan '{plan_name}' not found. Available plans: {tools._available_plans}"
+        return plan_info
 
-    return "\n\n".join(results)
+    return tools._pricing_full_text
 
 
 def compare_plans(plan1: str, plan2: str) -> str:
     """Compare two subscription plans side by side."""
     tools = get_data_tools()
-    df = tools._dataframes.get("pricing")
 
-    if df is None:
+    if "pricing" not in tools._records:
         return "Pricing information is currently unavailable."
 
-    plan1_df = df[df["plan_name"].str.lower() == plan1.lower()]
-    plan2_df = df[df["plan_name"].str.lower() == plan2.lower()]
+    p1 = tools._pricing_by_plan.get(plan1.lower())
+    p2 = tools._pricing_by_plan.get(plan2.lower())
 
-    if plan1_df.empty:
+    if p1 is None:
         return f"Plan '{plan1}' not found."
-    if plan2_df.empty:
+    if p2 is None:
         return f"Plan '{plan2}' not found."
 
-    p1 = plan1_df.iloc[0]
-    p2 = plan2_df.iloc[0]
-
     comparison = f"""
 **{p1['plan_name']} vs {p2['plan_name']} Comparison**
 
@@ -124,21 +268,20 @@ def compare_plans(plan1: str, plan2: str) -> str:
 def check_feature_availability(feature_name: str, plan_name: Optional[str] = None) -> str:
     """Check if a specific feature is available and on which plans."""
     tools = get_data_tools()
-    df = tools._dataframes.get("features")
 
-    if df is None:
+    if "features" not in tools._records:
         return "Feature information is currently unavailable."
 
-    matches = df[df["feature_name"].str.lower().str.contains(feature_name.lower())]
+    matches = tools.search("features", ["feature_name"], feature_name)
 
-    if matches.empty:
-        matches = df[df["description"].str.lower().str.contains(feature_name.lower())]
+    if not matches:
+        matches = tools.search("features", ["description"], feature_name)
 
-    if matches.empty:
+    if not matches:
         return f"No feature matching '{feature_name}' found."
 
     results = []
-    for _, row in matches.iterrows():
+    for row in matches:
         feature_info = f"""
 **{row['feature_name']}** ({row['feature_category']})
 {row['description']}
@@ -153,7 +296,7 @@ Availability by plan:
 
         if plan_name:
             plan_col = plan_name.lower()
-            if plan_col in row.index:
+            if plan_col in row:
                 availability = row[plan_col]
                 feature_info += f"\n\n→ On {plan_name} plan: {availability}"
 
@@ -165,21 +308,16 @@ Availability by plan:
 def get_support_resolution(issue_keyword: str) -> str:
     """Find resolution steps for common support issues."""
     tools = get_data_tools()
-    df = tools._dataframes.get("support_issues")
 
-    if df is None:
+    if "support_issues" not in tools._records:
         return "Support issue database is currently unavailable."
 
-    matches = df[
-        df["issue_title"].str.lower().str.contains(issue_keyword.lower()) |
-        df["category"].str.lower().str.contains(issue_keyword.lower())
-    ]
-
-    if matches.empty:
+    matches = tools.search("support_issues", ["issue_title", "category"], issue_keyword)
+    if not matches:
         return f"No common issues found matching '{issue_keyword}'. Please contact support@nimbusflow.io"
 
     results = []
-    for _, row in matches.iterrows():
+    for row in matches:
         issue_info = f"""
 **{row['issue_title']}**
 Category: {row['category']}
@@ -196,17 +334,11 @@ Typical Resolution Time: {row['avg_resolution_time_hours']} hours
 def list_all_plans() -> str:
     """List all available subscription plans with basic info."""
     tools = get_data_tools()
-    df = tools._dataframes.get("pricing")
 
-    if df is None:
+    if tools._plans_summary is None:
         return "Pricing information is currently unavailable."
 
-    plans = []
-    for _, row in df.iterrows():
-        price_str = f"${row['monthly_price_usd']}/mo" if row['monthly_price_usd'] != "Custom" else "Custom pricing"
-        plans.append(f"- **{row['plan_name']}**: {price_str} - Up to {row['max_users']} users")
-
-    return "**Available Plans:**\n" + "\n".join(plans)
+    return tools._plans_summary
 
 
 # =============================================================================
@@ -4,33 +4,139 @@ Customer Support Agent API
 FastAPI backend for the customer support chatbot.
 """
 
-import uuid
-from typing import Optional
-from datetime import datetime
+import asyncio
+import hashlib
+import secrets
+from typing import AsyncIterator, Optional
+from datetime import datetime, timezone
 from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, Header, HTTPException, Path, Query
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field
-
-from app.config import API_HOST, API_PORT, CORS_ORIGINS, COMPANY_NAME
-from app.agents.customer_agent import get_agent, clear_session
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
+import orjson
+from openai import APIConnectionError, OpenAIError, RateLimitError
+from pydantic import BaseModel, ConfigDict, Field
+
+from app.config import API_HOST, API_PORT, API_WORKERS, API_RELOAD, CORS_ORIGINS, COMPANY_NAME
+from app.agents.customer_agent import (
+    get_agent,
+    clear_session,
+    embed_messages,
+    invalidate_cached_responses,
+    invalidate_tool_cache,
+    session_stats,
+    warm_up,
+)
+from app.mcp_client import get_mcp_client
+
+# Blocking agent work (LLM, MCP and embedding calls) runs on the event loop's
+# default executor via asyncio.to_thread; size it for I/O-bound concurrency
+AGENT_WORKER_THREADS = 64
+
+# Seconds between background refreshes of the cached MCP tool list
+MCP_REFRESH_INTERVAL = 30.0
+
+# Largest accepted request body; a full /chat/batch of ASCII text is about 200KB
+MAX_REQUEST_BYTES = 1_048_576
+
+# Session ids are minted by _new_session_id (32 hex characters); accept other
+# short word-character ids but nothing that could bloat the session cache keys
+SESSION_ID_PATTERN = r"^[\w\-]{8,64}$"
+
+
+def _utcnow() -> datetime:
+    """Current time in UTC, for timestamps read by other machines."""
+    return datetime.now(timezone.utc)
+
+
+def _new_session_id() -> str:
+    """Random 128-bit session id as 32 hex characters."""
+    # Session ids are the only credential for a conversation's history, so they
+    # come from the OS CSPRNG; token_hex skips building and formatting a UUID
+    return secrets.token_hex(16)
+
+
+def _health_prefix(ready: bool) -> bytes:
+    """Encode the HealthResponse body up to the opening quote of its timestamp."""
+    body = orjson.dumps({
+        "status": "healthy",
+        "company": COMPANY_NAME,
+        "vector_store_ready": ready,  # Reusing field for MCP readiness
+    })
+    return body[:-1] + b',"timestamp":"'
+
+
+def _set_mcp_tools(app: FastAPI, tools: list) -> None:
+    """Cache the MCP tool list, readiness flag and encoded admin listing on app.state."""
+    if tools != getattr(app.state, "mcp_tools", None):
+        invalidate_tool_cache()
+    app.state.mcp_tools = tools
+    app.state.mcp_ready = len(tools) > 0
+    app.state.health_prefix = _health_prefix(app.state.mcp_ready)
+    app.state.mcp_tools_body = orjson.dumps({
+        "status": "success",
+        "tools": [
+            {
+                "name": tool["name"],
+                "description": tool.get("description", ""),
+            }
+            for tool in tools
+        ],
+    })
+    # Changes exactly when the listing does, so clients and caches can revalidate;
+    # weak because GZipMiddleware may send the same listing in another encoding
+    app.state.mcp_tools_etag = f'W/"{hashlib.sha1(app.state.mcp_tools_body).hexdigest()}"'
+
+
+async def _refresh_mcp_tools(app: FastAPI) -> None:
+    """Periodically re-list MCP tools so health checks never call the server themselves."""
+    while True:
+        await asyncio.sleep(MCP_REFRESH_INTERVAL)
+        try:
+            if app.state.mcp_client is None:
+                app.state.mcp_client = await asyncio.to_thread(get_mcp_client)
+            tools = await asyncio.to_thread(app.state.mcp_client.list_tools, True)
+        except Exception as e:
+            print(f"⚠️ MCP tool refresh failed: {e}")
+            tools = []
+        _set_mcp_tools(app, tools)
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Initialize resources on startup."""
     print("🚀 Starting Customer Support Agent API...")
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=AGENT_WORKER_THREADS, thread_name_prefix="agent")
+    )
     print("🔌 Initializing MCP server connection...")
+    app.state.mcp_client = None
+    tools = []
     try:
-        from app.mcp_client import get_mcp_client
-        mcp_client = get_mcp_client()
-        tools = mcp_client.list_tools()
-        print(f"✅ MCP server connected - {len(tools)} tools available")
+        app.state.mcp_client = get_mcp_client()
+        # A tool list restored from the init cache skips the handshake but isn't
+        # proof the server is up, so readiness always comes from a live listing
+        tools = app.state.mcp_client.list_tools(refresh=True)
+        if tools:
+            print(f"✅ MCP server connected - {len(tools)} tools available")
+        else:
+            print("⚠️ MCP server listed no tools; retrying in the background")
     except Exception as e:
         print(f"⚠️ MCP server initialization failed: {e}")
+    _set_mcp_tools(app, tools)
+    # Pay the first request's setup costs during startup instead
+    try:
+        await asyncio.to_thread(warm_up)
+        print("🔥 Agent warm-up complete")
+    except Exception as e:
+        print(f"⚠️ Agent warm-up failed: {e}")
+    refresh_task = asyncio.create_task(_refresh_mcp_tools(app))
     yield
     print("👋 Shutting down...")
+    refresh_task.cancel()
 
 
 app = FastAPI(
@@ -38,8 +144,70 @@ app = FastAPI(
     description="AI-powered customer support chatbot using MCP server",
     version="1.0.0",
     lifespan=lifespan,
+    default_response_class=ORJSONResponse,
 )
 
+class RequestSizeLimitMiddleware:
+    """Reject requests whose body exceeds a limit.
+
+    A declared Content-Length is checked before the body is read; chunked bodies
+    are counted as they are received and cut off once they pass the limit.
+    """
+
+    def __init__(self, app, max_bytes: int):
+        self.app = app
+        self.max_bytes = max_bytes
+
+    async def _reject(self, scope, receive, send):
+        response = ORJSONResponse(
+            {"detail": f"Request body larger than {self.max_bytes} bytes"},
+            status_code=413,
+        )
+        await response(scope, receive, send)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        for name, value in scope["headers"]:
+            if name == b"content-length":
+                if not value.isdigit() or int(value) > self.max_bytes:
+                    await self._reject(scope, receive, send)
+                    return
+                break
+
+        received = 0
+        started = False
+        rejected = False
+
+        async def limited_receive():
+            nonlocal received, rejected
+            message = await receive()
+            if message["type"] == "http.request" and not rejected:
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    rejected = True
+                    if not started:
+                        await self._reject(scope, receive, send)
+                    # The app stops reading as if the client left; its own
+                    # response is dropped by guarded_send
+                    return {"type": "http.disconnect"}
+            return message
+
+        async def guarded_send(message):
+            nonlocal started
+            if rejected:
+                return
+            started = True
+            await send(message)
+
+        await self.app(scope, limited_receive, guarded_send)
+
+
+# Added before CORS so that CORS wraps it and 413 responses stay readable by the browser
+app.add_middleware(RequestSizeLimitMiddleware, max_bytes=MAX_REQUEST_BYTES)
+# Chat replies and histories are repetitive JSON; small bodies aren't worth compressing
+app.add_middleware(GZipMiddleware, minimum_size=512, compresslevel=4)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=CORS_ORIGINS,
@@ -52,132 +220,344 @@ app.add_middleware(
 # Request/Response Models
 class ChatRequest(BaseModel):
     message: str = Field(..., min_length=1, max_length=4000)
-    session_id: Optional[str] = None
+    session_id: Optional[str] = Field(None, pattern=SESSION_ID_PATTERN)
 
 
 class ChatResponse(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     response: str
     session_id: str
-    sources_used: list[str] = []
-    tools_called: list[str] = []
+    sources_used: list[str] = Field(default_factory=list)
+    tools_called: list[str] = Field(default_factory=list)
     regenerations: int = 0
-    timestamp: datetime = Field(default_factory=datetime.now)
+    timestamp: datetime = Field(default_factory=_utcnow)
+
+
+# Upper bound on messages per /chat/batch call, to bound the work of one request
+MAX_BATCH_SIZE = 48
+
+
+class BatchChatRequest(BaseModel):
+    requests: list[ChatRequest] = Field(..., min_length=1, max_length=MAX_BATCH_SIZE)
+
+
+class BatchChatItem(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
+    session_id: str
+    result: Optional[ChatResponse] = None
+    error: Optional[str] = None
+
+
+class BatchChatResponse(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
+    results: list[BatchChatItem]
 
 
 class HealthResponse(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     status: str
     company: str
-    timestamp: datetime
+    timestamp: datetime = Field(default_factory=_utcnow)
     vector_store_ready: bool
 
 
 class SessionResponse(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     session_id: str
     message: str
 
 
 # Endpoints
+# Hot endpoints return a Response directly: FastAPI then skips re-validating
+# the server-built payload against response_model, which stays for the docs
 @app.get("/", response_model=HealthResponse)
-async def root():
-    """Root endpoint - health check."""
-    try:
-        from app.mcp_client import get_mcp_client
-        mcp_client = get_mcp_client()
-        tools = mcp_client.list_tools()
-        mcp_ready = len(tools) > 0
-    except:
-        mcp_ready = False
-
-    return HealthResponse(
-        status="healthy",
-        company=COMPANY_NAME,
-        timestamp=datetime.now(),
-        vector_store_ready=mcp_ready,  # Reusing field for MCP readiness
-    )
-
-
 @app.get("/health", response_model=HealthResponse)
 async def health_check():
-    """Detailed health check endpoint."""
-    try:
-        from app.mcp_client import get_mcp_client
-        mcp_client = get_mcp_client()
-        tools = mcp_client.list_tools()
-        mcp_ready = len(tools) > 0
-    except:
-        mcp_ready = False
-
-    return HealthResponse(
-        status="healthy",
-        company=COMPANY_NAME,
-        timestamp=datetime.now(),
-        vector_store_ready=mcp_ready,  # Reusing field for MCP readiness
+    """Health check with MCP readiness; served at / and /health."""
+    # Only the timestamp changes between checks; the rest is pre-encoded
+    return Response(
+        app.state.health_prefix + _utcnow().isoformat().encode() + b'"}',
+        media_type="application/json",
     )
 
 
 @app.post("/chat", response_model=ChatResponse)
 async def chat(request: ChatRequest):
     """Main chat endpoint."""
-    session_id = request.session_id or str(uuid.uuid4())
+    session_id = request.session_id or _new_session_id()
 
     try:
-        agent = get_agent(session_id)
-        result = agent.chat(request.message)
-
-        return ChatResponse(
-            response=result.message,
-            session_id=session_id,
-            sources_used=result.sources_used,
-            tools_called=result.tools_called,
-            regenerations=result.regenerations,
-            timestamp=datetime.now(),
-        )
+        # The agent blocks on network I/O; keep it off the event loop
+        agent = await asyncio.to_thread(get_agent, session_id)
+        result = await asyncio.to_thread(_locked_chat, agent, request.message)
+        return ORJSONResponse(_chat_response(session_id, result))
+    except OpenAIError as e:
+        status_code, detail = _chat_error(e)
+        raise HTTPException(status_code=status_code, detail=detail)
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
+        # A bug; answer with a handled 500 so the response still passes through
+        # CORSMiddleware instead of escaping to the server's bare error page
+        print(f"❌ Chat turn failed unexpectedly: {e!r}")
+        raise HTTPException(status_code=500, detail="The assistant could not answer this message.")
+
+
+def _chat_error(e: Exception) -> tuple[int, str]:
+    """Status code and client-facing message for a failed agent turn."""
+    if isinstance(e, RateLimitError):
+        return 429, "The assistant is handling too many requests; please retry shortly."
+    if isinstance(e, APIConnectionError):  # Includes timeouts
+        return 503, "The assistant is temporarily unavailable; please retry."
+    # Internal details go to the log, not to the client
+    print(f"❌ Chat turn failed: {e!r}")
+    return 500, "The assistant could not answer this message."
+
+
+@app.post("/chat/stream")
+async def chat_stream(request: ChatRequest):
+    """Chat endpoint streaming the reply as Server-Sent Events.
+
+    Each `data:` event is JSON: {"t": text delta} while the answer is generated,
+    then {"session_id", "sources_used", "tools_called"} for the turn (or
+    {"error"} if it failed), then the literal [DONE].
+    """
+    session_id = request.session_id or _new_session_id()
+    try:
+        agent = await asyncio.to_thread(get_agent, session_id)
+    except OpenAIError as e:
+        status_code, detail = _chat_error(e)
+        raise HTTPException(status_code=status_code, detail=detail)
+    except Exception as e:
+        print(f"❌ Chat stream setup failed unexpectedly: {e!r}")
+        raise HTTPException(status_code=500, detail="The assistant could not answer this message.")
+    return StreamingResponse(
+        _chat_events(agent, session_id, request.message),
+        media_type="text/event-stream",
+        # Content-Encoding: identity keeps GZipMiddleware from buffering events
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no", "Content-Encoding": "identity"},
+    )
+
+
+def _sse(payload) -> bytes:
+    """Encode one Server-Sent Events data event."""
+    return b"data: " + orjson.dumps(payload) + b"\n\n"
+
+
+async def _chat_events(agent, session_id: str, message: str) -> AsyncIterator[bytes]:
+    """Run a streamed agent turn on a worker thread and relay its parts as SSE events."""
+    loop = asyncio.get_running_loop()
+    parts: asyncio.Queue = asyncio.Queue()
+
+    def produce():
+        # The OpenAI client is sync; hand each part back to the event loop
+        try:
+            with agent.lock:
+                for part in agent.chat_stream(message):
+                    loop.call_soon_threadsafe(parts.put_nowait, part)
+        except Exception as e:
+            loop.call_soon_threadsafe(parts.put_nowait, e)
+        finally:
+            loop.call_soon_threadsafe(parts.put_nowait, None)
+
+    # Keep a reference so the turn finishes (and is recorded) even if the client leaves
+    producer = asyncio.ensure_future(asyncio.to_thread(produce))
+    last = None
+    while True:
+        part = await parts.get()
+        if part is None:
+            break
+        if isinstance(part, Exception):
+            yield _sse({"error": _chat_error(part)[1]})
+            last = None
+            break
+        if part.message:
+            yield _sse({"t": part.message})
+        last = part
+    await producer
+
+    if last is not None:
+        yield _sse({
+            "session_id": session_id,
+            "sources_used": last.sources_used,
+            "tools_called": last.tools_called,
+        })
+    yield b"data: [DONE]\n\n"
+
+
+def _locked_chat(agent, message: str, query_embedding: Optional[list[float]] = None):
+    """Run one agent turn; concurrent requests for the same session take turns."""
+    with agent.lock:
+        return agent.chat(message, query_embedding)
+
+
+def _chat_response(session_id: str, result) -> dict:
+    """Build the ChatResponse body for an agent result."""
+    return {
+        "response": result.message,
+        "session_id": session_id,
+        "sources_used": result.sources_used,
+        "tools_called": result.tools_called,
+        "regenerations": result.regenerations,
+        "timestamp": _utcnow(),
+    }
+
+
+@app.post("/chat/batch", response_model=BatchChatResponse)
+async def chat_batch(batch: BatchChatRequest):
+    """Answer several chat messages concurrently; failures are reported per item."""
+    # Reject the whole batch before doing any work if an item can't be answered
+    for index, request in enumerate(batch.requests):
+        if not request.message.strip():
+            raise HTTPException(
+                status_code=400,
+                detail={"error": f"Invalid item at index {index}: message is blank"},
+            )
+
+    session_ids = [request.session_id or _new_session_id() for request in batch.requests]
+
+    # Identical messages (ignoring surrounding whitespace) share one embedding,
+    # computed for all unique messages in a single request
+    unique_messages: dict[str, int] = {}
+    message_index = [
+        unique_messages.setdefault(request.message.strip(), len(unique_messages))
+        for request in batch.requests
+    ]
+    embeddings = await asyncio.to_thread(embed_messages, list(unique_messages))
+
+    # Messages for the same session run in order on one thread, since an
+    # agent's conversation state isn't safe to update concurrently
+    indices_by_session: dict[str, list[int]] = {}
+    for index, session_id in enumerate(session_ids):
+        indices_by_session.setdefault(session_id, []).append(index)
+
+    def run_session(session_id: str, indices: list[int]) -> list[dict]:
+        items = []
+        try:
+            agent = get_agent(session_id)
+        except Exception as e:
+            error = _chat_error(e)[1]
+            return [_batch_item(session_id, error=error) for _ in indices]
+        for index in indices:
+            try:
+                result = _locked_chat(
+                    agent, batch.requests[index].message, embeddings[message_index[index]]
+                )
+                items.append(_batch_item(session_id, result=_chat_response(session_id, result)))
+            except Exception as e:
+                # One failed message mustn't fail the rest of the batch
+                items.append(_batch_item(session_id, error=_chat_error(e)[1]))
+        return items
+
+    session_items = await asyncio.gather(*(
+        asyncio.to_thread(run_session, session_id, indices)
+        for session_id, indices in indices_by_session.items()
+    ))
+
+    results: list[Optional[dict]] = [None] * len(batch.requests)
+    for indices, items in zip(indices_by_session.values(), session_items):
+        for index, item in zip(indices, items):
+            results[index] = item
+    return ORJSONResponse({"results": results})
+
+
+def _batch_item(session_id: str, result: Optional[dict] = None, error: Optional[str] = None) -> dict:
+    """Build one BatchChatItem body."""
+    return {"session_id": session_id, "result": result, "error": error}
 
 
 @app.post("/session/new", response_model=SessionResponse)
 async def new_session():
     """Create a new conversation session."""
-    session_id = str(uuid.uuid4())
-    return SessionResponse(session_id=session_id, message="New session created")
+    session_id = _new_session_id()
+    return SessionResponse.model_construct(session_id=session_id, message="New session created")
 
 
 @app.post("/session/{session_id}/clear", response_model=SessionResponse)
-async def clear_conversation(session_id: str):
+async def clear_conversation(session_id: str = Path(..., pattern=SESSION_ID_PATTERN)):
     """Clear conversation history for a session."""
     clear_session(session_id)
-    return SessionResponse(session_id=session_id, message="Conversation cleared")
+    return SessionResponse.model_construct(session_id=session_id, message="Conversation cleared")
 
 
 @app.get("/session/{session_id}/history")
-async def get_history(session_id: str):
+async def get_history(session_id: str = Path(..., pattern=SESSION_ID_PATTERN)):
     """Get conversation history for a session."""
-    agent = get_agent(session_id)
-    return {"session_id": session_id, "history": agent.get_conversation_history()}
+    try:
+        agent = await asyncio.to_thread(get_agent, session_id)
+        history = await asyncio.to_thread(agent.get_conversation_history)
+    except OpenAIError as e:
+        status_code, detail = _chat_error(e)
+        raise HTTPException(status_code=status_code, detail=detail)
+    except Exception as e:
+        print(f"❌ Loading history failed unexpectedly: {e!r}")
+        raise HTTPException(status_code=500, detail="The conversation history could not be loaded.")
+    return {"session_id": session_id, "history": history}
+
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    """Weakly compare an If-None-Match header (a list of tags, or *) against an ETag."""
+    if if_none_match.strip() == "*":
+        return True
+    opaque = etag.removeprefix("W/")
+    return any(tag.strip().removeprefix("W/") == opaque for tag in if_none_match.split(","))
 
 
 @app.get("/admin/mcp-tools")
-async def list_mcp_tools():
+async def list_mcp_tools(if_none_match: Optional[str] = Header(None)):
     """List available MCP tools."""
+    # Kept current by the lifespan's background refresh, so a listing may be
+    # reused for one refresh interval and revalidated by ETag after that; admin
+    # responses are private so shared caches never store them
+    headers = {
+        "ETag": app.state.mcp_tools_etag,
+        "Cache-Control": f"private, max-age={int(MCP_REFRESH_INTERVAL)}",
+    }
+    if if_none_match and _etag_matches(if_none_match, app.state.mcp_tools_etag):
+        return Response(status_code=304, headers=headers)
+    return Response(app.state.mcp_tools_body, media_type="application/json", headers=headers)
+
+
+@app.get("/admin/sessions/stats")
+async def get_session_stats():
+    """Report active agent sessions and session lookup hits/misses."""
+    return {"status": "success", **session_stats()}
+
+
+@app.post("/admin/cache/invalidate")
+async def invalidate_cache(
+    topic: Optional[str] = None,
+    threshold: float = Query(0.8, ge=0.0, le=1.0),
+):
+    """Drop cached answers to questions about a topic, or all cached answers without one."""
     try:
-        from app.mcp_client import get_mcp_client
-        mcp_client = get_mcp_client()
-        tools = mcp_client.list_tools()
-        return {
-            "status": "success",
-            "tools": [
-                {
-                    "name": tool["name"],
-                    "description": tool.get("description", ""),
-                }
-                for tool in tools
-            ]
-        }
+        removed = await asyncio.to_thread(invalidate_cached_responses, topic, threshold)
+    except OpenAIError as e:
+        # Embedding the topic failed; nothing was removed
+        status_code, detail = _chat_error(e)
+        raise HTTPException(status_code=status_code, detail=detail)
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        print(f"❌ Cache invalidation failed unexpectedly: {e!r}")
+        raise HTTPException(status_code=500, detail="Cached answers could not be invalidated.")
+    return {"status": "success", "removed": removed}
 
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run("main:app", host=API_HOST, port=API_PORT, reload=True)
+    uvicorn.run(
+        "main:app",
+        host=API_HOST,
+        port=API_PORT,
+        # uvloop and httptools (from uvicorn[standard]) where available; neither
+        # supports Windows, where uvicorn falls back to asyncio and h11
+        loop="auto",
+        http="auto",
+        # The reloader supervises a single process
+        workers=1 if API_RELOAD else API_WORKERS,
+        reload=API_RELOAD,
+        backlog=2048,
+        timeout_keep_alive=30,
+    )